@@ -0,0 +1,184 @@
+import numpy as np
+
+from engine import (BUBBLE_NAMES, BOMB_NAMES, SPECIAL_BUBBLE_INDEX, SPECIAL_BUBBLE3_INDEX,
+                    TILE_BOMB, TILE_MATCHES, TILE_NORMAL, TILE_WILD, tile_flags_for)
+
+# offline batch evaluation of every adjacent swap on many boards at once;
+# boards are (N, rows, cols) uint8 arrays in the same encoding as Board.cells.
+# Legality is exact. Clear counts are exact for matches and colour-clears but
+# only an estimate for power-up swaps: each counts as one power-up of a fixed
+# size, while the game fires both bombs of a bomb+bomb swap, sets off every
+# bomb caught in a blast and walks the snake at random. engine.detonation_mask
+# gives the real cells for one board.
+
+SNAKE_STEPS = 10
+
+
+def default_bomb_indices():
+    first = len(BUBBLE_NAMES)
+    return list(range(first, first + len(BOMB_NAMES)))
+
+
+def stack_boards(grids):
+    rows, cols = grids[0].rows, grids[0].cols
+    buf = b"".join(bytes(g.cells) for g in grids)
+    return np.frombuffer(buf, dtype=np.uint8).reshape(len(grids), rows, cols).copy()
+
+
+def power_indices(bomb_indices, snake_index=None):
+    # the snake fires like a bomb, as engine.configure_tiles sets it up
+    powers = list(bomb_indices)
+    if snake_index is not None and snake_index not in powers:
+        powers.append(snake_index)
+    return powers
+
+
+def tile_tables(bomb_indices, snake_index=None):
+    flags = np.frombuffer(bytes(tile_flags_for(power_indices(bomb_indices, snake_index), snake_index)),
+                          dtype=np.uint8)
+    block = (flags & TILE_MATCHES) == 0
+    wild = (flags & TILE_WILD) != 0
+    bomb = (flags & TILE_BOMB) != 0
+    normal = (flags & TILE_NORMAL) != 0
+    return block, wild, bomb, normal
+
+
+def bomb_clear_table(bomb_indices, snake_index, rows, cols):
+    # nominal cells cleared when each power-up goes off alone: a row, a column
+    # or a cross, SNAKE_STEPS for the snake and the mean shape for extra
+    # bombs, which pick one at random. Chains and second bombs aren't counted
+    sizes = [cols, rows, rows + cols - 1]
+    clears = np.zeros(256, dtype=np.int32)
+    for v in bomb_indices:
+        if v == snake_index:
+            clears[v] = SNAKE_STEPS
+        elif v in bomb_indices[:3]:
+            clears[v] = sizes[list(bomb_indices[:3]).index(v)]
+        else:
+            clears[v] = round(sum(sizes) / 3)
+    return clears
+
+
+def line_runs(values, block, wild):
+    # cells in a run of three or more along the last axis; a window of three
+    # open cells matches some base exactly when its non-wild tiles agree, so
+    # pairwise comparisons replace a pass per base colour
+    open_ = ~block[values]
+    wilds = wild[values] & open_
+    pair = (values[..., :-1] == values[..., 1:]) | wilds[..., :-1] | wilds[..., 1:]
+    skip = (values[..., :-2] == values[..., 2:]) | wilds[..., :-2] | wilds[..., 2:]
+    h = open_[..., :-2] & open_[..., 1:-1] & open_[..., 2:] & pair[..., :-1] & pair[..., 1:] & skip
+    mask = np.zeros(values.shape, dtype=bool)
+    mask[..., :-2] |= h
+    mask[..., 1:-1] |= h
+    mask[..., 2:] |= h
+    return mask
+
+
+def match_mask(boards, block, wild):
+    horizontal = line_runs(boards, block, wild)
+    vertical = line_runs(boards.transpose(0, 2, 1), block, wild).transpose(0, 2, 1)
+    return horizontal | vertical
+
+
+def _matched_after_right_swaps(boards, block, wild):
+    # number of cells inside matches after swapping (r, c) with (r, c + 1),
+    # for every board and position at once; only row r and columns c and c + 1
+    # change, so those lines are re-run on swapped copies and the rest of the
+    # board is taken from the unswapped masks
+    n, rows, cols = boards.shape
+    h0 = line_runs(boards, block, wild)
+    columns = boards.transpose(0, 2, 1)
+    v0 = line_runs(columns, block, wild).transpose(0, 2, 1)
+    u0 = h0 | v0
+
+    perm = np.tile(np.arange(cols), (cols - 1, 1))
+    idx = np.arange(cols - 1)
+    perm[idx, idx] = idx + 1
+    perm[idx, idx + 1] = idx
+    # swapped_rows[n, r, c, :] is row r of board n after the swap at (r, c)
+    swapped_rows = boards[:, :, perm]
+    h_row = line_runs(swapped_rows, block, wild)
+
+    # column c (and c + 1) after the swap at (r, c), laid out [n, r, c, line]
+    on_row = np.eye(rows, dtype=bool)[None, :, None, :]
+    col_left = np.where(on_row, boards[:, :, 1:, None], columns[:, None, :-1, :])
+    col_right = np.where(on_row, boards[:, :, :-1, None], columns[:, None, 1:, :])
+    v_left = line_runs(col_left, block, wild)
+    v_right = line_runs(col_right, block, wild)
+
+    at_c = (idx[:, None] == np.arange(cols)[None, :])[None, None]
+    at_c1 = (idx[:, None] + 1 == np.arange(cols)[None, :])[None, None]
+    v_left_here = np.diagonal(v_left, axis1=1, axis2=3).transpose(0, 2, 1)[..., None]
+    v_right_here = np.diagonal(v_right, axis1=1, axis2=3).transpose(0, 2, 1)[..., None]
+    row_v = np.where(at_c, v_left_here, np.where(at_c1, v_right_here, v0[:, :, None, :]))
+    in_row = (h_row | row_v).sum(axis=-1)
+
+    h_cols = h0.transpose(0, 2, 1)
+    in_left = ((v_left | h_cols[:, None, :-1, :]) & ~on_row).sum(axis=-1)
+    in_right = ((v_right | h_cols[:, None, 1:, :]) & ~on_row).sum(axis=-1)
+
+    row_sums = u0.sum(axis=2)
+    col_sums = u0.sum(axis=1)
+    rest = (u0.sum(axis=(1, 2))[:, None, None]
+            - row_sums[:, :, None]
+            - col_sums[:, None, :-1] - col_sums[:, None, 1:]
+            + u0[:, :, :-1] + u0[:, :, 1:])
+    return rest + in_row + in_left + in_right
+
+
+def _evaluate_right_swaps(boards, tables, bomb_clears, colour_counts):
+    # swaps of (r, c) with (r, c + 1); vertical swaps run through the transpose
+    block, wild, bomb, normal = tables
+    n = boards.shape[0]
+    a = boards[:, :, :-1]
+    b = boards[:, :, 1:]
+    any_bomb = bomb[a] | bomb[b]
+    blocked = (a == SPECIAL_BUBBLE_INDEX) | (b == SPECIAL_BUBBLE_INDEX)
+    a_clear = (a == SPECIAL_BUBBLE3_INDEX) & normal[b]
+    b_clear = (b == SPECIAL_BUBBLE3_INDEX) & normal[a]
+    colour_clear = a_clear | b_clear
+    matched = _matched_after_right_swaps(boards, block, wild)
+
+    power = np.where(bomb[b], b, a)
+    target = np.where(a_clear, b, a)
+    board_idx = np.arange(n)[:, None, None]
+    clears = np.where(
+        any_bomb, bomb_clears[power],
+        np.where(blocked, 0,
+                 np.where(colour_clear, colour_counts[board_idx, target] + 1, matched)))
+    legal = any_bomb | (~blocked & (colour_clear | (matched > 0)))
+    return legal, clears
+
+
+def evaluate_swaps(boards, bomb_indices=None, snake_index=None, chunk=4096):
+    # returns (legal_h, clears_h, legal_v, clears_v); entry [n, r, c] of the
+    # _h arrays is the swap of (r, c) with (r, c + 1) on board n, and of the _v
+    # arrays the swap of (r, c) with (r + 1, c). Power-up clears are the
+    # estimate from bomb_clear_table
+    boards = np.ascontiguousarray(boards, dtype=np.uint8)
+    if bomb_indices is None:
+        bomb_indices = default_bomb_indices()
+    bomb_indices = power_indices(bomb_indices, snake_index)
+    n, rows, cols = boards.shape
+    tables = tile_tables(bomb_indices, snake_index)
+    bomb_clears = bomb_clear_table(bomb_indices, snake_index, rows, cols)
+
+    colour_counts = np.zeros((n, 256), dtype=np.int32)
+    for v in np.flatnonzero(tables[3]):
+        colour_counts[:, v] = (boards == v).sum(axis=(1, 2))
+
+    legal_h = np.zeros((n, rows, cols - 1), dtype=bool)
+    clears_h = np.zeros((n, rows, cols - 1), dtype=np.int32)
+    legal_v = np.zeros((n, rows - 1, cols), dtype=bool)
+    clears_v = np.zeros((n, rows - 1, cols), dtype=np.int32)
+    # chunked so the per-position temporaries stay small on huge batches
+    for lo in range(0, n, chunk):
+        part = slice(lo, lo + chunk)
+        legal_h[part], clears_h[part] = _evaluate_right_swaps(
+            boards[part], tables, bomb_clears, colour_counts[part])
+        transposed = np.ascontiguousarray(boards[part].transpose(0, 2, 1))
+        legal, clears = _evaluate_right_swaps(transposed, tables, bomb_clears, colour_counts[part])
+        legal_v[part] = legal.transpose(0, 2, 1)
+        clears_v[part] = clears.transpose(0, 2, 1)
+    return legal_h, clears_h, legal_v, clears_v
@@ -0,0 +1,246 @@
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import engine
+from engine import CLASSIC_MODES, DIFFICULTY_SETTINGS, GameState, scan_moves
+from hints import HintSearch, immediate_points
+
+# Monte Carlo balancing: plays many headless games per difficulty on every
+# core and reports score, length, "no more moves" rate and power-up use.
+# Game i of a difficulty is seeded from "seed/difficulty/i", so the same
+# arguments always give the same report whatever the number of workers.
+#
+#   python balance.py --games 20000 --policy greedy --out report.json
+
+# time a move takes on screen: the player's think time plus one highlight
+# per clear step (main.HIGHLIGHT_DELAY_MS)
+THINK_MS = 1500
+CLEAR_MS = 600
+# Free Play has no timer, so its games stop here if the board never locks
+MAX_SWAPS = 2000
+POWERS = ("colour", "bomb", "snake")
+
+
+def policy_random(game, rng):
+    moves = game.legal_moves()
+    return moves[rng.randrange(len(moves))]
+
+
+def policy_first(game, rng):
+    return game.legal_moves()[0]
+
+
+def policy_greedy(game, rng):
+    # best immediate clear, ties broken at random
+    best = []
+    top = -1
+    for move in game.legal_moves():
+        points = immediate_points(game.grid, move, rng)
+        if points > top:
+            best, top = [move], points
+        elif points == top:
+            best.append(move)
+    return best[rng.randrange(len(best))]
+
+
+def policy_lookahead(game, rng):
+    # the hint engine's choice, one swap deep with its cascade sampled
+    return HintSearch.for_game(game, depth=1).finish()
+
+
+POLICIES = {"random": policy_random, "first": policy_first, "greedy": policy_greedy,
+            "lookahead": policy_lookahead}
+
+
+def load_policy(name):
+    # a built-in name or "module:function" taking (game, rng)
+    if name in POLICIES:
+        return POLICIES[name]
+    module, _, func = name.partition(":")
+    return getattr(importlib.import_module(module), func)
+
+
+def configure(settings):
+    # applied once in every worker before any game is played
+    engine.BOMB_UNLOCK_SCORE = settings["bomb_unlock"]
+    engine.BOMB_CADENCE = settings["bomb_cadence"]
+    engine.SNAKE_UNLOCK_SCORE = settings["snake_unlock"]
+    engine.set_spawn_tiers(*settings["spawn_tiers"])
+    DIFFICULTY_SETTINGS.update(settings["durations"])
+
+
+def check_moves(game, rng, seed):
+    # tries a swap the rules refuse, as a player's misclick would, then holds
+    # the move index to a full scan; a refused swap once left the index blind
+    # to every later write
+    grid = game.grid
+    legal = set(game.legal_moves())
+    refused = [m for m in (((r, c), (r2, c2)) for r in range(grid.rows) for c in range(grid.cols)
+                           for (r2, c2) in ((r, c + 1), (r + 1, c)) if r2 < grid.rows and c2 < grid.cols)
+               if m not in legal]
+    if refused:
+        move = refused[rng.randrange(len(refused))]
+        result = game.swap(*move[0], *move[1])
+        if result is not None and result["accepted"]:
+            raise ValueError(f"swap {move} outside the move index was accepted in game {seed}")
+    if game.legal_moves() != scan_moves(grid):
+        raise ValueError(f"move index disagrees with a full scan after {game.swaps} swaps in game {seed}")
+
+
+def play_game(difficulty, seed, policy, think_ms, max_swaps, reshuffle=False, check=False):
+    game = GameState(difficulty, seed=seed, reshuffle=reshuffle)
+    policy_rng = random.Random(seed + "/policy")
+    check_rng = random.Random(seed + "/check")
+    powers = dict.fromkeys(POWERS, 0)
+    bombs = 0
+    shuffles = 0
+    while not game.is_over() and game.swaps < max_swaps:
+        if check:
+            check_moves(game, check_rng, seed)
+        move = policy(game, policy_rng)
+        result = game.swap(*move[0], *move[1])
+        if result is None or not result["accepted"]:
+            raise ValueError(f"policy chose an illegal swap {move} in game {seed}")
+        if result["cause"] in powers:
+            powers[result["cause"]] += 1
+        bombs += result["bombs"]
+        shuffles += result["shuffled"]
+        game.step(think_ms + result["clears"] * CLEAR_MS)
+    end = game.end or "cap"
+    return (game.score, game.swaps, game.now // 1000, end,
+            powers["colour"], powers["bomb"], powers["snake"], bombs, shuffles)
+
+
+def run_chunk(task):
+    difficulty, start, count, settings = task
+    policy = load_policy(settings["policy"])
+    games = []
+    for i in range(start, start + count):
+        seed = f"{settings['seed']}/{difficulty}/{i}"
+        games.append(play_game(difficulty, seed, policy, settings["think_ms"], settings["max_swaps"],
+                               settings["reshuffle"], settings["check_moves"]))
+    return difficulty, games
+
+
+def percentiles(values, points=(10, 25, 50, 75, 90, 99)):
+    ordered = sorted(values)
+    n = len(ordered)
+    return {f"p{p}": ordered[min(n - 1, p * n // 100)] for p in points}
+
+
+def histogram(values, width):
+    bins = {}
+    for v in values:
+        b = v // width * width
+        bins[b] = bins.get(b, 0) + 1
+    return {str(b): bins[b] for b in sorted(bins)}
+
+
+def summarise(games, bin_width):
+    n = len(games)
+    columns = list(zip(*games))
+    scores, swaps, seconds, ends = columns[0], columns[1], columns[2], columns[3]
+    report = {
+        "games": n,
+        "score": {"mean": sum(scores) / n, "min": min(scores), "max": max(scores), **percentiles(scores),
+                  "histogram": histogram(scores, bin_width)},
+        "swaps": {"mean": sum(swaps) / n, **percentiles(swaps), "histogram": histogram(swaps, 10)},
+        "seconds": {"mean": sum(seconds) / n, **percentiles(seconds)},
+        "ends": {end: ends.count(end) / n for end in ("time", "moves", "cap") if end in ends},
+        "no_moves_rate": ends.count("moves") / n,
+        "shuffles": {"mean": sum(columns[8]) / n, "games_with": sum(1 for v in columns[8] if v) / n},
+        "powers": {},
+    }
+    for k, name in enumerate(POWERS + ("bombs_dropped",)):
+        per_game = columns[4 + k]
+        report["powers"][name] = {"mean": sum(per_game) / n, "games_with": sum(1 for v in per_game if v) / n,
+                                  "histogram": histogram(per_game, 1)}
+    return report
+
+
+def parse_durations(items):
+    durations = {}
+    for item in items:
+        name, _, value = item.partition("=")
+        if name not in DIFFICULTY_SETTINGS:
+            raise SystemExit(f"unknown difficulty {name!r}")
+        durations[name] = None if value.lower() in ("", "none") else int(value)
+    return durations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play headless games per difficulty and report balance statistics.")
+    parser.add_argument("--games", type=int, default=1000, help="games per difficulty")
+    parser.add_argument("--difficulty", action="append", choices=list(DIFFICULTY_SETTINGS),
+                        help="difficulty to play, repeatable (default: the classic board ones)")
+    parser.add_argument("--seed", default="0")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk", type=int, default=250, help="games per worker task")
+    parser.add_argument("--policy", default="random", help="random, first, greedy, lookahead or module:function")
+    parser.add_argument("--think-ms", type=int, default=THINK_MS, help="clock time a move takes before its clears")
+    parser.add_argument("--max-swaps", type=int, default=MAX_SWAPS)
+    parser.add_argument("--reshuffle", action="store_true", help="deal the board out again instead of ending on no moves")
+    parser.add_argument("--check-moves", action="store_true",
+                        help="try a refused swap before every move and check the move index against a full scan")
+    parser.add_argument("--bomb-unlock", type=int, default=engine.BOMB_UNLOCK_SCORE)
+    parser.add_argument("--bomb-cadence", type=int, default=engine.BOMB_CADENCE)
+    parser.add_argument("--snake-unlock", type=int, default=engine.SNAKE_UNLOCK_SCORE)
+    parser.add_argument("--spawn-tiers", default=",".join(str(t) for t in engine.SPAWN_TIERS[:3]),
+                        help="colour-clear,wild,blocker spawn scores")
+    parser.add_argument("--duration", action="append", default=[], metavar="NAME=SECONDS",
+                        help="override a difficulty's timer, repeatable")
+    parser.add_argument("--bin", type=int, default=250, help="score histogram bin width")
+    parser.add_argument("--out", help="write the JSON report here")
+    args = parser.parse_args(argv)
+
+    load_policy(args.policy)
+    settings = {
+        "seed": args.seed,
+        "policy": args.policy,
+        "think_ms": args.think_ms,
+        "max_swaps": args.max_swaps,
+        "reshuffle": args.reshuffle,
+        "check_moves": args.check_moves,
+        "bomb_unlock": args.bomb_unlock,
+        "bomb_cadence": args.bomb_cadence,
+        "snake_unlock": args.snake_unlock,
+        "spawn_tiers": [int(t) for t in args.spawn_tiers.split(",")],
+        "durations": parse_durations(args.duration),
+    }
+    configure(settings)
+    difficulties = args.difficulty or CLASSIC_MODES
+    tasks = [(d, start, min(args.chunk, args.games - start), settings)
+             for d in difficulties for start in range(0, args.games, args.chunk)]
+
+    results = {d: [] for d in difficulties}
+    began = time.perf_counter()
+    # imap keeps task order, so the report doesn't depend on worker timing
+    with multiprocessing.Pool(args.jobs, initializer=configure, initargs=(settings,)) as pool:
+        for done, (difficulty, games) in enumerate(pool.imap(run_chunk, tasks), 1):
+            results[difficulty].extend(games)
+            print(f"\r{done}/{len(tasks)} chunks", end="", file=sys.stderr, flush=True)
+    took = time.perf_counter() - began
+    total = sum(len(g) for g in results.values())
+    print(f"\r{total} games in {took:.1f}s ({total / took:.0f} games/s)", file=sys.stderr)
+
+    report = {
+        "settings": {**settings, "durations": {d: DIFFICULTY_SETTINGS[d] for d in difficulties}},
+        "difficulties": {d: summarise(results[d], args.bin) for d in difficulties},
+    }
+    for d, r in report["difficulties"].items():
+        print(f"{d:10} score mean {r['score']['mean']:8.1f} p50 {r['score']['p50']:6}"
+              f"  swaps mean {r['swaps']['mean']:6.1f}  no moves {r['no_moves_rate']:6.1%}"
+              f"  bombs/game {r['powers']['bomb']['mean']:5.2f}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
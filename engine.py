@@ -0,0 +1,1520 @@
+import random
+import time
+
+# the game rules, kept free of pygame so they can run without a display;
+# main.py draws the game and drives a GameState from its frame loop
+
+GRID_COLS = 9
+GRID_ROWS = 9
+
+DIFFICULTY_SETTINGS = {
+    "Easy": 150,
+    "Normal": 110,
+    "Hard": 60,
+    "Free Play": None,
+    "Mega": None
+}
+# (rows, cols) for the modes that don't play on the classic board
+BOARD_SIZES = {
+    "Mega": (64, 64)
+}
+CLASSIC_MODES = [d for d in DIFFICULTY_SETTINGS if d not in BOARD_SIZES]
+
+BUBBLE_NAMES = [f"bubble{i}" for i in range(1, 10)]
+SPECIAL_BUBBLE_INDEX = 6
+SPECIAL_BUBBLE2_INDEX = 7
+SPECIAL_BUBBLE3_INDEX = 8
+BOMB_NAMES = ["bomb1", "bomb2", "bomb3"]
+BOMB_INDICES = list(range(len(BUBBLE_NAMES), len(BUBBLE_NAMES) + len(BOMB_NAMES)))
+# the snake follows the bombs in the tile ids; main.py sets it to None
+# when the snake image is missing
+SNAKE_INDEX = len(BUBBLE_NAMES) + len(BOMB_NAMES)
+
+BOMB_UNLOCK_SCORE = 1500
+SNAKE_UNLOCK_SCORE = 3000
+BOMB_CADENCE = 40
+
+
+def in_bounds(r, c):
+    return 0 <= r < GRID_ROWS and 0 <= c < GRID_COLS
+
+def board_size(difficulty):
+    return BOARD_SIZES.get(difficulty, (GRID_ROWS, GRID_COLS))
+
+def are_adjacent(a, b):
+    (r1, c1), (r2, c2) = a, b
+    return (abs(r1 - r2) == 1 and c1 == c2) or (abs(c1 - c2) == 1 and r1 == r2)
+
+EMPTY = 255
+
+# per-tile property bits, looked up by tile id in TILE_FLAGS
+TILE_NORMAL = 1
+TILE_WILD = 2
+TILE_BLOCKER = 4
+TILE_COLOUR_CLEAR = 8
+TILE_BOMB = 16
+TILE_SNAKE = 32
+TILE_EMPTY = 64
+TILE_MATCHES = TILE_NORMAL | TILE_WILD
+
+TILE_FLAGS = bytearray(256)
+MATCH_BASES = []
+BOMB_TYPES = {}
+
+def tile_flags_for(bomb_indices, snake_index):
+    flags = bytearray(256)
+    for v in range(len(BUBBLE_NAMES)):
+        flags[v] = TILE_NORMAL
+    flags[SPECIAL_BUBBLE_INDEX] = TILE_BLOCKER
+    flags[SPECIAL_BUBBLE2_INDEX] = TILE_WILD
+    flags[SPECIAL_BUBBLE3_INDEX] = TILE_COLOUR_CLEAR
+    for v in bomb_indices:
+        flags[v] = TILE_BOMB
+    if snake_index is not None:
+        flags[snake_index] = (flags[snake_index] & TILE_BOMB) | TILE_SNAKE
+    flags[EMPTY] = TILE_EMPTY
+    return flags
+
+def build_tile_flags(bomb_indices, snake_index):
+    # filled in place so hot loops can keep a reference to the table
+    TILE_FLAGS[:] = tile_flags_for(bomb_indices, snake_index)
+    MATCH_BASES[:] = [i for i in range(len(BUBBLE_NAMES)) if i != SPECIAL_BUBBLE_INDEX and i != SPECIAL_BUBBLE2_INDEX]
+    # the first three bombs clear a row, a column and a cross
+    BOMB_TYPES.clear()
+    for kind, v in enumerate(list(bomb_indices)[:3]):
+        BOMB_TYPES[v] = kind
+
+def configure_tiles(bomb_indices, snake_index):
+    global SNAKE_INDEX
+    # the snake only reaches the board once unlocked, so it can carry its
+    # bomb flag from the start
+    BOMB_INDICES[:] = bomb_indices
+    SNAKE_INDEX = snake_index
+    powers = list(bomb_indices)
+    if snake_index is not None:
+        powers.append(snake_index)
+    build_tile_flags(powers, snake_index)
+
+configure_tiles(BOMB_INDICES, SNAKE_INDEX)
+
+class Board:
+    __slots__ = ("rows", "cols", "cells", "trackers", "where", "journal")
+
+    def __init__(self, rows=GRID_ROWS, cols=GRID_COLS, cells=None):
+        self.rows = rows
+        self.cols = cols
+        # one byte per cell, row-major; EMPTY marks a cleared cell
+        self.cells = bytearray([EMPTY]) * (rows * cols) if cells is None else cells
+        # sets of flat indices written since their owner last looked
+        self.trackers = []
+        # where[v] is the set of flat indices holding tile v, once indexed
+        self.where = None
+        # flat (index, old tile) pairs written since the first checkpoint()
+        self.journal = None
+
+    @classmethod
+    def from_rows(cls, rows):
+        cells = bytearray(EMPTY if v is None else v for row in rows for v in row)
+        return cls(len(rows), len(rows[0]), cells)
+
+    def in_bounds(self, r, c):
+        return 0 <= r < self.rows and 0 <= c < self.cols
+
+    def to_rows(self):
+        cols = self.cols
+        return [[None if v == EMPTY else v for v in self.cells[r * cols:(r + 1) * cols]] for r in range(self.rows)]
+
+    def track(self):
+        dirty = set()
+        self.trackers.append(dirty)
+        return dirty
+
+    def untrack(self, dirty):
+        # by identity, since two trackers can hold equal sets
+        self.trackers = [d for d in self.trackers if d is not dirty]
+
+    def mark(self, i):
+        for dirty in self.trackers:
+            dirty.add(i)
+
+    def index_colours(self):
+        where = [set() for _ in range(256)]
+        for i, v in enumerate(self.cells):
+            where[v].add(i)
+        self.where = where
+
+    def count(self, v):
+        if self.where is None:
+            self.index_colours()
+        return len(self.where[v])
+
+    def get(self, r, c):
+        return self.cells[r * self.cols + c]
+
+    def set(self, r, c, v):
+        self.set_at(r * self.cols + c, v)
+
+    def set_at(self, i, v):
+        old = self.cells[i]
+        if old == v:
+            return
+        self.cells[i] = v
+        if self.journal is not None:
+            self.journal += (i, old)
+        if self.where is not None:
+            self.where[old].discard(i)
+            self.where[v].add(i)
+        for dirty in self.trackers:
+            dirty.add(i)
+
+    def clear_mask(self, mask):
+        while mask:
+            low = mask & -mask
+            self.set_at(low.bit_length() - 1, EMPTY)
+            mask ^= low
+
+    def is_empty(self, r, c):
+        return self.cells[r * self.cols + c] == EMPTY
+
+    def swap(self, r1, c1, r2, c2):
+        cells = self.cells
+        i = r1 * self.cols + c1
+        j = r2 * self.cols + c2
+        a, b = cells[i], cells[j]
+        if a == b:
+            return
+        cells[i], cells[j] = b, a
+        if self.journal is not None:
+            self.journal += (i, a, j, b)
+        if self.where is not None:
+            self.where[a].discard(i)
+            self.where[a].add(j)
+            self.where[b].discard(j)
+            self.where[b].add(i)
+        for dirty in self.trackers:
+            dirty.add(i)
+            dirty.add(j)
+
+    def copy(self):
+        return Board(self.rows, self.cols, bytearray(self.cells))
+
+    def checkpoint(self):
+        # a point rewind() can take the board back to; it costs what was
+        # written since, not a copy of the board, so searches can make and
+        # unmake moves in place. Checkpoints nest
+        if self.journal is None:
+            self.journal = []
+        return len(self.journal)
+
+    def rewind(self, point):
+        journal = self.journal
+        self.journal = None
+        while len(journal) > point:
+            old = journal.pop()
+            self.set_at(journal.pop(), old)
+        # back at the first checkpoint nothing is left to record for
+        if point:
+            self.journal = journal
+
+    def snapshot(self):
+        return bytes(self.cells)
+
+    def restore(self, snap):
+        cells = self.cells
+        if self.where is None and not self.trackers and self.journal is None:
+            cells[:] = snap
+            return
+        # only the cells that differ, so the colour index and trackers see
+        # the same writes a move would have made
+        for i in [i for i, (a, b) in enumerate(zip(cells, snap)) if a != b]:
+            self.set_at(i, snap[i])
+
+def random_cell(score=0):
+    if score < 1000:
+        return random.randrange(0, len(BUBBLE_NAMES) - 1)
+    else:
+        pool = list(range(len(BUBBLE_NAMES) - 1)) * 10
+        pool.append(SPECIAL_BUBBLE_INDEX)
+        return random.choice(pool)
+
+def create_grid(no_start_matches=True, ensure_move=True, rng=random, rows=GRID_ROWS, cols=GRID_COLS):
+    for grid in build_grid(no_start_matches, ensure_move, rng, rows, cols):
+        pass
+    return grid
+
+def build_grid(no_start_matches=True, ensure_move=True, rng=random, rows=GRID_ROWS, cols=GRID_COLS):
+    # create_grid a row at a time: yields None after each row and the board
+    # last, drawing from rng in the same order so a seed gives the same board
+    grid = Board(rows, cols)
+    cells = grid.cells
+    draws = draw_cells(0, len(cells), rng)
+    if not no_start_matches:
+        cells[:] = bytes(draws)
+        yield grid
+        return
+
+    # fill in reading order; a colour that would finish a run of three with
+    # the two cells to the left or the two above is redrawn from the rest
+    colours = [v for v in range(len(BUBBLE_NAMES)) if TILE_FLAGS[v] & TILE_NORMAL]
+    cols = grid.cols
+    for i in range(len(cells)):
+        r, c = divmod(i, cols)
+        left = cells[i - 1] if c >= 2 and cells[i - 1] == cells[i - 2] else EMPTY
+        up = cells[i - cols] if r >= 2 and cells[i - cols] == cells[i - 2 * cols] else EMPTY
+        v = draws[i]
+        if v == left or v == up:
+            v = rng.choice([x for x in colours if x != left and x != up])
+        cells[i] = v
+        if c == cols - 1:
+            yield None
+
+    if ensure_move and not has_moves(grid):
+        yield None
+        plant_move(grid, rng)
+    yield grid
+
+def plant_move(grid, rng=random):
+    # lay out "x x _ x" somewhere so sliding the last x in completes a run,
+    # trying spots and colours until one fits without making a match
+    cells = grid.cells
+    rows, cols = grid.rows, grid.cols
+    colours = [v for v in range(len(BUBBLE_NAMES)) if TILE_FLAGS[v] & TILE_NORMAL]
+    spots = [(r, c, 0, 1) for r in range(rows) for c in range(cols - 3)]
+    spots += [(r, c, 1, 0) for r in range(rows - 3) for c in range(cols)]
+    rng.shuffle(spots)
+    rng.shuffle(colours)
+    for r, c, dr, dc in spots:
+        idx = [(r + k * dr) * cols + c + k * dc for k in range(4)]
+        saved = [cells[i] for i in idx]
+        for x in colours:
+            if saved[2] == x:
+                continue
+            for k in (0, 1, 3):
+                grid.set_at(idx[k], x)
+            if not any(forms_match_at(grid, *divmod(idx[k], cols)) for k in (0, 1, 3)):
+                return True
+            for i, v in zip(idx, saved):
+                grid.set_at(i, v)
+    return False
+
+def reshuffle_board(grid, rng=random):
+    # deals the plain colours back out over their own cells, specials left
+    # where they are, so the board has no match and at least one swap. One
+    # swap is laid out first as "x x y" with another x beside the y; the rest
+    # goes in reading order, each cell taking the most plentiful colour that
+    # doesn't finish a run, and the odd cell where none fits is traded with
+    # one elsewhere. Returns False, leaving the board as it was, if it can't
+    cells = grid.cells
+    rows, cols = grid.rows, grid.cols
+    before = bytes(cells)
+    spots = [i for i, v in enumerate(before) if TILE_FLAGS[v] & TILE_NORMAL]
+    counts = {}
+    for i in spots:
+        counts[before[i]] = counts.get(before[i], 0) + 1
+    for i in spots:
+        cells[i] = EMPTY
+
+    def fits(i):
+        return not forms_match_at(grid, *divmod(i, cols))
+
+    fixed = set()
+    triples = [v for v in counts if counts[v] >= 3]
+    if triples and len(counts) >= 2:
+        normal = set(spots)
+        x = max(triples, key=lambda v: counts[v])
+        y = max((v for v in counts if v != x), key=lambda v: counts[v])
+        order = list(spots)
+        rng.shuffle(order)
+        for a in order:
+            r, c = divmod(a, cols)
+            for dr, dc in ((0, 1), (1, 0), (0, -1), (-1, 0)):
+                gr, gc = r + 2 * dr, c + 2 * dc
+                b, gap = a + dr * cols + dc, gr * cols + gc
+                if not (0 <= gr < rows and 0 <= gc < cols) or b not in normal or gap not in normal:
+                    continue
+                # any neighbour of the gap off the line can slide an x into it
+                for sr, sc in ((gr + dc, gc + dr), (gr - dc, gc - dr), (gr + dr, gc + dc)):
+                    d = sr * cols + sc
+                    if not (0 <= sr < rows and 0 <= sc < cols) or d not in normal:
+                        continue
+                    for k, v in ((a, x), (b, x), (d, x), (gap, y)):
+                        cells[k] = v
+                    if fits(a) and fits(b) and fits(d) and fits(gap):
+                        fixed = {a, b, d, gap}
+                        break
+                    for k in (a, b, d, gap):
+                        cells[k] = EMPTY
+                if fixed:
+                    break
+            if fixed:
+                counts[x] -= 3
+                counts[y] -= 1
+                break
+
+    colours = list(counts)
+    rng.shuffle(colours)
+    stuck = []
+    for i in spots:
+        if i in fixed:
+            continue
+        best = None
+        for v in sorted(colours, key=counts.__getitem__, reverse=True):
+            if not counts[v]:
+                break
+            cells[i] = v
+            if fits(i):
+                best = v
+                break
+        if best is None:
+            best = max(colours, key=counts.__getitem__)
+            cells[i] = best
+            stuck.append(i)
+        counts[best] -= 1
+
+    free = [i for i in spots if i not in fixed]
+    for i in stuck:
+        if fits(i):
+            continue
+        start = rng.randrange(len(free))
+        for j in free[start:] + free[:start]:
+            if cells[j] == cells[i]:
+                continue
+            cells[i], cells[j] = cells[j], cells[i]
+            if fits(i) and fits(j):
+                break
+            cells[i], cells[j] = cells[j], cells[i]
+        else:
+            cells[:] = before
+            return False
+
+    after = bytes(cells)
+    cells[:] = before
+    if not fixed and not has_moves(Board(rows, cols, bytearray(after))):
+        return False
+    grid.restore(after)
+    return True
+
+# spawn weights per score tier, built once: every normal colour has weight 10,
+# the blocker joins at 1000, the wild at 6000, and from 8000 the colour-clear
+# is added with weight 1 on a quarter of draws
+SPAWN_TIERS = (8000, 6000, 1000, 0)
+SPAWN_TABLES = {}
+
+def set_spawn_tiers(colour_clear, wild, blocker):
+    # scores at which colour-clears, wilds and blockers start to spawn
+    global SPAWN_TIERS
+    SPAWN_TIERS = (colour_clear, wild, blocker, 0)
+    SPAWN_TABLES.clear()
+
+def spawn_pool(tier, with_colour_clear):
+    specials = {SPECIAL_BUBBLE_INDEX, SPECIAL_BUBBLE2_INDEX, SPECIAL_BUBBLE3_INDEX}
+    pool = {i: 10 for i in range(len(BUBBLE_NAMES)) if i not in specials}
+    if tier >= SPAWN_TIERS[2]:
+        pool[SPECIAL_BUBBLE_INDEX] = 1
+    if tier >= SPAWN_TIERS[1]:
+        pool[SPECIAL_BUBBLE2_INDEX] = 1
+    if with_colour_clear:
+        pool[SPECIAL_BUBBLE3_INDEX] = 1
+    return pool
+
+def spawn_table(score):
+    tier = next(t for t in SPAWN_TIERS if score >= t)
+    table = SPAWN_TABLES.get(tier)
+    if table is None:
+        pool = spawn_pool(tier, False)
+        if tier >= SPAWN_TIERS[0]:
+            # mix the two pools 3:1 over a common denominator so the integer
+            # weights give exactly the old per-draw odds
+            gated = spawn_pool(tier, True)
+            n0, n1 = sum(pool.values()), sum(gated.values())
+            pool = {v: 3 * pool.get(v, 0) * n1 + gated[v] * n0 for v in gated}
+        values = sorted(pool)
+        cum = []
+        total = 0
+        for v in values:
+            total += pool[v]
+            cum.append(total)
+        table = (values, cum)
+        SPAWN_TABLES[tier] = table
+    return table
+
+def draw_cells(score, n, rng=random):
+    values, cum = spawn_table(score)
+    return rng.choices(values, cum_weights=cum, k=n)
+
+
+def find_all_matches(grid):
+    groups = []
+    cells = grid.cells
+    rows, cols = grid.rows, grid.cols
+    for r in range(rows):
+        base_i = r * cols
+        c = 0
+        while c < cols:
+            start = c
+            val = cells[base_i + c]
+            run = 1
+            c += 1
+            while c < cols and cells[base_i + c] == val:
+                run += 1
+                c += 1
+            if run >= 3 and not TILE_FLAGS[val] & (TILE_EMPTY | TILE_BLOCKER | TILE_SNAKE | TILE_WILD):
+                group = {(r, cc) for cc in range(start, start + run)}
+                groups.append(group)
+
+    for c in range(cols):
+        r = 0
+        while r < rows:
+            start = r
+            val = cells[r * cols + c]
+            run = 1
+            r += 1
+            while r < rows and cells[r * cols + c] == val:
+                run += 1
+                r += 1
+            if run >= 3 and not TILE_FLAGS[val] & (TILE_EMPTY | TILE_BLOCKER | TILE_SNAKE | TILE_WILD):
+                group = {(rr, c) for rr in range(start, start + run)}
+                groups.append(group)
+
+    return groups
+
+def find_all_matches_wild(grid):
+    groups = []
+    cells = grid.cells
+    rows, cols = grid.rows, grid.cols
+
+    flags = TILE_FLAGS
+    stop = TILE_EMPTY | TILE_BLOCKER | TILE_SNAKE
+
+    for r in range(rows):
+        c = 0
+        while c < cols:
+            run = []
+            base = None
+            while c < cols:
+                v = cells[r * cols + c]
+                if flags[v] & stop:
+                    break
+                if flags[v] & TILE_WILD:
+                    run.append((r, c))
+                    c += 1
+                    continue
+                if base is None:
+                    base = v
+                    run.append((r, c))
+                    c += 1
+                    continue
+                if v == base:
+                    run.append((r, c))
+                    c += 1
+                else:
+                    break
+            if len(run) >= 3:
+                groups.append(set(run))
+            if not run:
+                c += 1
+
+    for c in range(cols):
+        r = 0
+        while r < rows:
+            run = []
+            base = None
+            while r < rows:
+                v = cells[r * cols + c]
+                if flags[v] & stop:
+                    break
+                if flags[v] & TILE_WILD:
+                    run.append((r, c))
+                    r += 1
+                    continue
+                if base is None:
+                    base = v
+                    run.append((r, c))
+                    r += 1
+                    continue
+                if v == base:
+                    run.append((r, c))
+                    r += 1
+                else:
+                    break
+            if len(run) >= 3:
+                groups.append(set(run))
+            if not run:
+                r += 1
+
+    return groups
+
+def find_all_matches_wild_any(grid):
+    return find_matches_in_lines(grid, range(grid.rows), range(grid.cols))
+
+def find_matches_in_lines(grid, rows, cols):
+    groups = []
+    cells = grid.cells
+    width, height = grid.cols, grid.rows
+    flags = TILE_FLAGS
+    rows = sorted(rows)
+    cols = sorted(cols)
+
+    for base in MATCH_BASES:
+        for r in rows:
+            row_i = r * width
+            c = 0
+            while c < width:
+                run = []
+                while c < width:
+                    v = cells[row_i + c]
+                    f = flags[v]
+                    if f & TILE_WILD or (v == base and f & TILE_NORMAL):
+                        run.append((r, c))
+                        c += 1
+                    else:
+                        break
+                if len(run) >= 3:
+                    groups.append(set(run))
+                c = c + 1 if not run else c
+
+    for base in MATCH_BASES:
+        for c in cols:
+            r = 0
+            while r < height:
+                run = []
+                while r < height:
+                    v = cells[r * width + c]
+                    f = flags[v]
+                    if f & TILE_WILD or (v == base and f & TILE_NORMAL):
+                        run.append((r, c))
+                        r += 1
+                    else:
+                        break
+                if len(run) >= 3:
+                    groups.append(set(run))
+                r = r + 1 if not run else r
+
+    return groups
+
+def scan_line_runs(cells, start, step, length, runs, line, horizontal, k=0):
+    # one pass over a line from position k: a run keeps one base colour and
+    # absorbs wilds, and when the colour changes the next run starts at the
+    # wilds just before it
+    flags = TILE_FLAGS
+    while k < length:
+        if not flags[cells[start + k * step]] & TILE_MATCHES:
+            k += 1
+            continue
+        run_start = k
+        wild_start = k
+        base = -1
+        while k < length:
+            v = cells[start + k * step]
+            f = flags[v]
+            if f & TILE_WILD:
+                k += 1
+                continue
+            if not f & TILE_NORMAL:
+                break
+            if base != -1 and v != base:
+                if k - run_start >= 3:
+                    runs.append((horizontal, line, run_start, k))
+                run_start = wild_start
+            base = v
+            k += 1
+            wild_start = k
+        if k - run_start >= 3:
+            runs.append((horizontal, line, run_start, k))
+
+def find_runs_in_lines(grid, rows, cols):
+    runs = []
+    cells = grid.cells
+    width, height = grid.cols, grid.rows
+    for r in sorted(rows):
+        scan_line_runs(cells, r * width, 1, width, runs, r, True)
+    for c in sorted(cols):
+        scan_line_runs(cells, c, width, height, runs, c, False)
+    return runs
+
+def run_break(cells, a, b):
+    # True when no run can take in both of two neighbouring cells: one of
+    # them never matches, or they are two different plain colours
+    fa = TILE_FLAGS[cells[a]]
+    fb = TILE_FLAGS[cells[b]]
+    if not fa & TILE_MATCHES or not fb & TILE_MATCHES:
+        return True
+    return fa & fb & TILE_NORMAL and cells[a] != cells[b]
+
+def find_runs_near(grid, dirty):
+    # find_runs_in_lines for a settled board written at the dirty cells. Any
+    # new run takes in a dirty cell, so each line is scanned only from the
+    # run break before its first dirty cell to the one after its last, which
+    # on a big board is a few cells where the whole line used to be
+    runs = []
+    cells = grid.cells
+    width, height = grid.cols, grid.rows
+    # in reading order the first and last dirty cell of each line come
+    # first and last
+    across = {}
+    across_end = {}
+    down = {}
+    down_end = {}
+    for i in sorted(dirty):
+        r, c = divmod(i, width)
+        across.setdefault(r, c)
+        across_end[r] = c
+        down.setdefault(c, r)
+        down_end[c] = r
+    for lines, ends, step, length, horizontal in ((across, across_end, 1, width, True),
+                                                  (down, down_end, width, height, False)):
+        for line in sorted(lines):
+            start = line * width if horizontal else line
+            lo = lines[line]
+            hi = ends[line]
+            while lo > 0 and not run_break(cells, start + (lo - 1) * step, start + lo * step):
+                lo -= 1
+            while hi < length - 1 and not run_break(cells, start + hi * step, start + (hi + 1) * step):
+                hi += 1
+            scan_line_runs(cells, start, step, hi + 1, runs, line, horizontal, lo)
+    return runs
+
+def run_cells(run):
+    horizontal, line, a, b = run
+    if horizontal:
+        return [(line, k) for k in range(a, b)]
+    return [(k, line) for k in range(a, b)]
+
+def run_shape(h, v):
+    # where a row run and a column run cross: end of both is an L, end of one
+    # a T, the middle of both a cross; None if they don't meet
+    _, r, c0, c1 = h
+    _, c, r0, r1 = v
+    if not (c0 <= c < c1 and r0 <= r < r1):
+        return None
+    h_end = c == c0 or c == c1 - 1
+    v_end = r == r0 or r == r1 - 1
+    if h_end and v_end:
+        return "L"
+    if h_end or v_end:
+        return "T"
+    return "cross"
+
+SHAPE_RANK = {"line": 0, "L": 1, "T": 2, "cross": 3}
+
+def merge_runs(runs):
+    # union-find over cells: runs that share a cell end up in one group
+    parent = {}
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for run in runs:
+        cells = run_cells(run)
+        for cell in cells:
+            parent.setdefault(cell, cell)
+        first = find(cells[0])
+        for cell in cells[1:]:
+            other = find(cell)
+            if other != first:
+                parent[other] = first
+
+    groups = []
+    by_root = {}
+    for run in runs:
+        root = find(run_cells(run)[0])
+        group = by_root.get(root)
+        if group is None:
+            group = {"cells": set(), "runs": []}
+            by_root[root] = group
+            groups.append(group)
+        group["runs"].append(run)
+    for cell in parent:
+        by_root[find(cell)]["cells"].add(cell)
+
+    for group in groups:
+        shape = "line"
+        for h in group["runs"]:
+            if not h[0]:
+                continue
+            for v in group["runs"]:
+                if v[0]:
+                    continue
+                s = run_shape(h, v)
+                if s is not None and SHAPE_RANK[s] > SHAPE_RANK[shape]:
+                    shape = s
+        group["shape"] = shape
+        group["size"] = len(group["cells"])
+    return groups
+
+def find_match_groups(grid, rows=None, cols=None):
+    if rows is None:
+        rows = range(grid.rows)
+    if cols is None:
+        cols = range(grid.cols)
+    return merge_runs(find_runs_in_lines(grid, rows, cols))
+
+def find_dirty_matches(grid, dirty):
+    # every match on the board runs through a dirty cell, so only the
+    # stretches of line around them are scanned; matched cells stay dirty
+    # until they are cleared
+    matches = merge_runs(find_runs_near(grid, dirty))
+    dirty.clear()
+    for group in matches:
+        for (r, c) in group["cells"]:
+            dirty.add(r * grid.cols + c)
+    return matches
+
+def has_any_match(grid):
+    return len(find_all_matches_wild_any(grid)) > 0
+
+def apply_gravity_and_refill(grid, score, rng=random):
+    cells = grid.cells
+    cols = grid.cols
+    # the lowest gap in each column that has one; nothing below it moves
+    lowest = {}
+    i = cells.find(EMPTY)
+    while i != -1:
+        lowest[i % cols] = i // cols
+        i = cells.find(EMPTY, i + 1)
+    gaps = []
+    drops = []
+    for c in sorted(lowest):
+        write_r = lowest[c]
+        for r in range(write_r, -1, -1):
+            v = cells[r * cols + c]
+            if v != EMPTY:
+                if write_r != r:
+                    grid.set(write_r, c, v)
+                    drops.append((r * cols + c, write_r * cols + c))
+                write_r -= 1
+        for r in range(write_r, -1, -1):
+            gaps.append(r * cols + c)
+    # one batched draw for the whole refill
+    spawns = list(zip(gaps, draw_cells(score, len(gaps), rng)))
+    for i, v in spawns:
+        grid.set_at(i, v)
+    # (from, to) flat indices of tiles that fell and (index, tile) of new ones
+    return drops, spawns
+
+def would_match_after_swap(grid, r1, c1, r2, c2):
+    cells = grid.cells
+    i = r1 * grid.cols + c1
+    j = r2 * grid.cols + c2
+    a = cells[i]
+    b = cells[j]
+
+    fa = TILE_FLAGS[a]
+    fb = TILE_FLAGS[b]
+
+    if (fa | fb) & TILE_BOMB:
+        return True
+
+    if (fa | fb) & TILE_BLOCKER:
+        return False
+
+    if fa & TILE_COLOUR_CLEAR and fb & TILE_NORMAL:
+        return True
+    if fb & TILE_COLOUR_CLEAR and fa & TILE_NORMAL:
+        return True
+
+    # probe on the raw buffer so trackers don't see the temporary swap; on a
+    # settled board any new match must run through one of the swapped cells
+    cells[i], cells[j] = b, a
+    ok = forms_match_at(grid, r1, c1) or forms_match_at(grid, r2, c2)
+    cells[i], cells[j] = a, b
+    return ok
+
+def forms_match_at(grid, r, c):
+    cells = grid.cells
+    rows, cols = grid.rows, grid.cols
+    flags = TILE_FLAGS
+
+    i = r * cols + c
+    v = cells[i]
+    fv = flags[v]
+    if not fv & TILE_MATCHES:
+        return False
+    if fv & TILE_NORMAL:
+        # a plain colour only runs through its own colour and wilds, which
+        # skips the per-base bookkeeping below on almost every probe. Unrolled,
+        # since the move index spends most of its time here
+        for step, pos, length in ((1, c, cols), (cols, r, rows)):
+            run = 1
+            if pos:
+                n = cells[i - step]
+                if n == v or flags[n] & TILE_WILD:
+                    run = 2
+                    if pos > 1:
+                        n = cells[i - 2 * step]
+                        if n == v or flags[n] & TILE_WILD:
+                            return True
+            if pos + 1 < length:
+                n = cells[i + step]
+                if n == v or flags[n] & TILE_WILD:
+                    if run == 2:
+                        return True
+                    if pos + 2 < length:
+                        n = cells[i + 2 * step]
+                        if n == v or flags[n] & TILE_WILD:
+                            return True
+        return False
+    for step, pos, length in ((1, c, cols), (cols, r, rows)):
+        # a wild: neighbours up to two cells away on each side, stopping at
+        # blockers, with a run tried for each colour among them
+        left = []
+        for k in range(1, min(2, pos) + 1):
+            n = cells[i - k * step]
+            if not flags[n] & TILE_MATCHES:
+                break
+            left.append(n)
+        right = []
+        for k in range(1, min(2, length - 1 - pos) + 1):
+            n = cells[i + k * step]
+            if not flags[n] & TILE_MATCHES:
+                break
+            right.append(n)
+        # -1 never equals a tile, so it stands for an all-wild run
+        bases = {n for n in left + right if not flags[n] & TILE_WILD}
+        bases.add(-1)
+        for base in bases:
+            run = 1
+            for side in (left, right):
+                for n in side:
+                    if n != base and not flags[n] & TILE_WILD:
+                        break
+                    run += 1
+            if run >= 3:
+                return True
+    return False
+
+def has_moves(grid):
+    rows, cols = grid.rows, grid.cols
+    for r in range(rows):
+        for c in range(cols):
+            if c + 1 < cols and would_match_after_swap(grid, r, c, r, c + 1):
+                return True
+            if r + 1 < rows and would_match_after_swap(grid, r, c, r + 1, c):
+                return True
+    return False
+
+def scan_moves(grid):
+    # every legal swap from a full scan, in MoveIndex.list() order
+    rows, cols = grid.rows, grid.cols
+    return [((r, c), (r2, c2)) for r in range(rows) for c in range(cols)
+            for (r2, c2) in ((r, c + 1), (r + 1, c))
+            if r2 < rows and c2 < cols and would_match_after_swap(grid, r, c, r2, c2)]
+
+PROBE_SWAPS = {}
+
+def probe_swaps(rows, cols):
+    # for each flat cell, the swaps whose probe reads it: a swap reads both
+    # its cells and two cells either side of them along their row and column
+    swaps = PROBE_SWAPS.get((rows, cols))
+    if swaps is None:
+        move = {}
+        for r in range(rows):
+            for c in range(cols):
+                if c + 1 < cols:
+                    move[r, c, 0] = ((r, c), (r, c + 1))
+                if r + 1 < rows:
+                    move[r, c, 1] = ((r, c), (r + 1, c))
+        swaps = []
+        for r in range(rows):
+            for c in range(cols):
+                near = set()
+                for er, ec in ((r, c), (r, c - 1), (r, c - 2), (r, c + 1), (r, c + 2),
+                               (r - 1, c), (r - 2, c), (r + 1, c), (r + 2, c)):
+                    if 0 <= er < rows and 0 <= ec < cols:
+                        for key in ((er, ec, 0), (er, ec - 1, 0), (er, ec, 1), (er - 1, ec, 1)):
+                            if key in move:
+                                near.add(move[key])
+                swaps.append(tuple(near))
+        PROBE_SWAPS[(rows, cols)] = swaps
+    return swaps
+
+class MoveIndex:
+    # legal swaps of a settled board, kept as ((r1, c1), (r2, c2)) pairs with
+    # the second cell right of or below the first; cells written since the last
+    # query only re-test the swaps whose probe window can see them
+    def __init__(self, grid):
+        self.grid = grid
+        self.moves = set()
+        self.dirty = grid.track()
+        # flat offsets of the cells a swap's probe reads around each of its
+        # cells; wrapping past a row end only makes any() more careful
+        cols = grid.cols
+        self.window = (0, -1, -2, 1, 2, -cols, -2 * cols, cols, 2 * cols)
+        self.rebuild()
+
+    def rebuild(self):
+        grid = self.grid
+        self.dirty.clear()
+        self.moves.clear()
+        for r in range(grid.rows):
+            for c in range(grid.cols):
+                self._check(r, c, r, c + 1)
+                self._check(r, c, r + 1, c)
+
+    def _check(self, r1, c1, r2, c2):
+        grid = self.grid
+        if r2 >= grid.rows or c2 >= grid.cols or r1 < 0 or c1 < 0:
+            return
+        move = ((r1, c1), (r2, c2))
+        if would_match_after_swap(grid, r1, c1, r2, c2):
+            self.moves.add(move)
+        else:
+            self.moves.discard(move)
+
+    def sync(self):
+        if not self.dirty:
+            return
+        grid = self.grid
+        rows, cols = grid.rows, grid.cols
+        if len(self.dirty) * 4 > rows * cols:
+            self.rebuild()
+            return
+        # every swap whose probe reads a written cell, gathered per cell from
+        # a table so the union runs in C
+        swaps = probe_swaps(rows, cols)
+        todo = set()
+        for i in self.dirty:
+            todo.update(swaps[i])
+        self.dirty.clear()
+        moves = self.moves
+        for move in todo:
+            (r1, c1), (r2, c2) = move
+            if would_match_after_swap(grid, r1, c1, r2, c2):
+                moves.add(move)
+            else:
+                moves.discard(move)
+
+    def any(self):
+        # a known move nothing has been written near is still legal; failing
+        # that has_moves stops at the first swap it finds. Either way the
+        # dirty area waits for the next list(), which a big board rarely needs
+        # after every swap
+        dirty = self.dirty
+        if not dirty:
+            return len(self.moves) > 0
+        window = self.window
+        cols = self.grid.cols
+        for (r1, c1), (r2, c2) in self.moves:
+            i = r1 * cols + c1
+            j = r2 * cols + c2
+            if dirty.isdisjoint([i + k for k in window]) and dirty.isdisjoint([j + k for k in window]):
+                return True
+        return has_moves(self.grid)
+
+    def list(self):
+        self.sync()
+        return sorted(self.moves)
+
+    def close(self):
+        self.grid.untrack(self.dirty)
+
+def score_for_chain(length):
+    if length < 3:
+        return 0
+    if length >= 5:
+        return 20 + (length - 3) * 20 
+    return 15 + (length - 3) * 15
+
+
+EFFECT_MASKS = {}
+
+def effect_masks(rows, cols):
+    masks = EFFECT_MASKS.get((rows, cols))
+    if masks is None:
+        row_bits = (1 << cols) - 1
+        col_bits = 0
+        for r in range(rows):
+            col_bits |= 1 << (r * cols)
+        row = [row_bits << (i - i % cols) for i in range(rows * cols)]
+        col = [col_bits << (i % cols) for i in range(rows * cols)]
+        cross = [row[i] | col[i] for i in range(rows * cols)]
+        masks = (row, col, cross)
+        EFFECT_MASKS[(rows, cols)] = masks
+    return masks
+
+def mask_bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def mask_cells(grid, mask):
+    cols = grid.cols
+    return {divmod(i, cols) for i in mask_bits(mask)}
+
+def cells_mask(grid, cells):
+    mask = 0
+    for (r, c) in cells:
+        mask |= 1 << (r * grid.cols + c)
+    return mask
+
+def colour_mask(grid, v):
+    if grid.where is None:
+        grid.index_colours()
+    mask = 0
+    for i in grid.where[v]:
+        mask |= 1 << i
+    return mask
+
+def power_mask(grid, v, i, rng=random):
+    r, c = divmod(i, grid.cols)
+    if TILE_FLAGS[v] & TILE_SNAKE:
+        return cells_mask(grid, generate_snake_path(r, c, steps=10, rows=grid.rows, cols=grid.cols, rng=rng))
+    bomb_type = BOMB_TYPES.get(v)
+    if bomb_type is None:
+        bomb_type = rng.randrange(0, 3)
+    return effect_masks(grid.rows, grid.cols)[bomb_type][i]
+
+def detonation_mask(grid, fired, rng=random):
+    # fired holds (tile, flat index) for each power-up set off; any bomb
+    # caught in the blast goes off too, so a whole chain is one OR'd mask
+    cells = grid.cells
+    mask = 0
+    done = 0
+    queue = list(fired)
+    while queue:
+        v, i = queue.pop()
+        if done >> i & 1:
+            continue
+        done |= 1 << i
+        hit = power_mask(grid, v, i, rng)
+        for j in mask_bits(hit & ~mask & ~done):
+            w = cells[j]
+            if TILE_FLAGS[w] & TILE_BOMB:
+                queue.append((w, j))
+        mask |= hit
+    return mask
+
+def insert_random_bomb_top(grid, bomb_indices, rng=random):
+    if not bomb_indices:
+        return None
+    c = rng.randrange(0, grid.cols)
+    bomb_idx = rng.choice(bomb_indices)
+    for r in range(grid.rows - 1, 0, -1):
+        grid.set(r, c, grid.get(r - 1, c))
+    grid.set(0, c, bomb_idx)
+    return c, bomb_idx
+
+def generate_snake_path(start_r, start_c, steps=10, rows=GRID_ROWS, cols=GRID_COLS, rng=random):
+    path = [(start_r, start_c)]
+    for _ in range(steps - 1):
+        r, c = path[-1]
+        nbrs = []
+        if r > 0: nbrs.append((r - 1, c))
+        if r < rows - 1: nbrs.append((r + 1, c))
+        if c > 0: nbrs.append((r, c - 1))
+        if c < cols - 1: nbrs.append((r, c + 1))
+        rng.shuffle(nbrs)
+        if len(path) >= 2:
+            prev = path[-2]
+            if prev in nbrs:
+                nbrs.remove(prev)
+                nbrs.append(prev)
+        if nbrs:
+            path.append(nbrs[0])
+        else:
+            break
+    return path
+
+def resolve_move(grid, r1, c1, r2, c2, score=0, rng=random, bomb_time=0, bombs_unlocked=False,
+                 moves=None, record=True, bomb_pool=None, cadence=True, reshuffle=False):
+    # plays a swap and its whole cascade on grid in one call
+    return run_steps(resolve_steps(grid, r1, c1, r2, c2, score, rng, bomb_time, bombs_unlocked, moves, record,
+                                   bomb_pool, cadence, reshuffle))
+
+def run_steps(work):
+    # drives a generator like resolve_steps to the end and returns its result
+    while True:
+        try:
+            next(work)
+        except StopIteration as stop:
+            return stop.value
+
+# how much of a frame main.py lets a swap's cascade take; the rest of it
+# waits for the next frame
+RESOLVE_BUDGET_MS = 8
+
+def run_slice(work, budget_ms):
+    # steps work until another step as long as the longest so far would
+    # overrun budget_ms, always at least once; (True, its result) once it
+    # has finished, else (False, None)
+    began = now = time.perf_counter()
+    deadline = began + budget_ms / 1000
+    longest = 0
+    while now == began or now + longest <= deadline:
+        try:
+            next(work)
+        except StopIteration as stop:
+            return True, stop.value
+        after = time.perf_counter()
+        longest = max(longest, after - now)
+        now = after
+    return False, None
+
+def resolve_steps(grid, r1, c1, r2, c2, score=0, rng=random, bomb_time=0, bombs_unlocked=False,
+                  moves=None, record=True, bomb_pool=None, cadence=True, reshuffle=False):
+    # resolve_move a step at a time: yields None after each clear, each fall
+    # and each search for the next matches, so a frame loop can spread a
+    # long cascade over several frames, and returns the result. With record set,
+    # result["events"] lists what happened for the renderer to replay:
+    #   ("swap", (r1, c1), (r2, c2))
+    #   ("clear", cause, groups, sizes, points, snake_path)
+    #   ("fall", drops, spawns, board_snapshot)
+    #   ("bomb", col, tile, board_snapshot)
+    #   ("shuffle", board_snapshot)
+    #   ("settled", has_moves)
+    # where cause is "match", "colour", "bomb" or "snake". The result also
+    # counts clear steps ("clears"), timer-bonus steps ("steps") and cadence
+    # bombs dropped ("bombs"). bomb_pool lists the power-ups the cadence can
+    # drop in and gains the snake once it unlocks; with cadence off nothing
+    # unlocks and no power-up is dropped in. With reshuffle set a board left
+    # without a swap is dealt out again instead
+    result = {"accepted": False, "blocked": False, "cause": None, "events": [], "points": 0,
+              "steps": 0, "clears": 0, "bombs": 0, "shuffled": False, "score": score, "bomb_time": bomb_time,
+              "bombs_unlocked": bombs_unlocked, "moves": True}
+    events = result["events"]
+    if bomb_pool is None:
+        # a copy, since the snake unlock appends to it
+        bomb_pool = list(BOMB_INDICES)
+    cols = grid.cols
+    a = grid.get(r1, c1)
+    b = grid.get(r2, c2)
+    fa = TILE_FLAGS[a]
+    fb = TILE_FLAGS[b]
+    if (fa | fb) & TILE_BLOCKER and not (fa | fb) & TILE_BOMB:
+        result["blocked"] = True
+        return result
+
+    dirty = grid.track()
+    grid.swap(r1, c1, r2, c2)
+    groups = None
+    path = None
+    if fa & TILE_COLOUR_CLEAR and fb & TILE_NORMAL:
+        cause = "colour"
+        clear = colour_mask(grid, b) | 1 << (r2 * cols + c2)
+    elif fb & TILE_COLOUR_CLEAR and fa & TILE_NORMAL:
+        cause = "colour"
+        clear = colour_mask(grid, a) | 1 << (r1 * cols + c1)
+    elif (fa | fb) & TILE_BOMB:
+        # each power-up goes off where the swap left it
+        fired = []
+        if fa & TILE_BOMB:
+            fired.append((a, r2 * cols + c2))
+        if fb & TILE_BOMB:
+            fired.append((b, r1 * cols + c1))
+        if len(fired) == 1 and TILE_FLAGS[fired[0][0]] & TILE_SNAKE:
+            cause = "snake"
+            r, c = divmod(fired[0][1], cols)
+            path = generate_snake_path(r, c, steps=10, rows=grid.rows, cols=cols, rng=rng)
+            clear = cells_mask(grid, path)
+        else:
+            cause = "bomb"
+            clear = detonation_mask(grid, fired, rng)
+    else:
+        cause = "match"
+        groups = find_dirty_matches(grid, dirty)
+        if not groups:
+            grid.swap(r1, c1, r2, c2)
+            grid.untrack(dirty)
+            return result
+        yield
+
+    result["accepted"] = True
+    result["cause"] = cause
+    if record:
+        events.append(("swap", (r1, c1), (r2, c2)))
+    while True:
+        if groups is not None:
+            sizes = [g["size"] for g in groups]
+            points = sum(score_for_chain(n) for n in sizes)
+            clear = 0
+            for g in groups:
+                for (r, c) in g["cells"]:
+                    clear |= 1 << (r * cols + c)
+            highlight = [g["cells"] for g in groups] if record else None
+        elif cause == "snake":
+            sizes = [len(path)]
+            points = 0
+            highlight = None
+        else:
+            highlight = [mask_cells(grid, clear)] if record else None
+            sizes = [bin(clear).count("1")]
+            points = score_for_chain(sizes[0])
+
+        # matches and bombs feed the bomb cadence and the timer bonus
+        if cause == "match" or cause == "bomb":
+            bomb_time += 1
+            result["steps"] += 1
+        score += points
+        result["points"] += points
+        result["clears"] += 1
+        if record:
+            events.append(("clear", cause, highlight, sizes, points, path))
+
+        grid.clear_mask(clear)
+        yield
+        drops, spawns = apply_gravity_and_refill(grid, score, rng)
+        if record:
+            events.append(("fall", drops, spawns, grid.snapshot()))
+        yield
+
+        if cadence and not bombs_unlocked and score >= BOMB_UNLOCK_SCORE:
+            bombs_unlocked = True
+            bomb_time = 0
+        if cadence and bombs_unlocked and bomb_time >= BOMB_CADENCE:
+            placed = insert_random_bomb_top(grid, bomb_pool, rng)
+            bomb_time = 0
+            if placed:
+                result["bombs"] += 1
+            if placed and record:
+                events.append(("bomb", placed[0], placed[1], grid.snapshot()))
+        if cadence and score >= SNAKE_UNLOCK_SCORE and SNAKE_INDEX is not None and SNAKE_INDEX not in bomb_pool:
+            bomb_pool.append(SNAKE_INDEX)
+
+        groups = find_dirty_matches(grid, dirty)
+        if not groups:
+            break
+        cause = "match"
+        path = None
+        yield
+
+    grid.untrack(dirty)
+    yield
+    result["moves"] = moves.any() if moves is not None else has_moves(grid)
+    if not result["moves"] and reshuffle and reshuffle_board(grid, rng):
+        result["moves"] = True
+        result["shuffled"] = True
+        if record:
+            events.append(("shuffle", grid.snapshot()))
+    result["score"] = score
+    result["bomb_time"] = bomb_time
+    result["bombs_unlocked"] = bombs_unlocked
+    if record:
+        events.append(("settled", result["moves"]))
+    return result
+
+def add_time(seconds, timer_duration, timer_start, now):
+    timer_start += seconds * (timer_duration*15 )
+    if timer_duration:
+        elapsed = (now - timer_start) // 1000
+        remaining = timer_duration - elapsed
+        if remaining > timer_duration:
+            timer_start = now
+    return timer_start
+
+class BoardPrefetcher:
+    # the next game's seed and starting board for every board size, built a
+    # row per step() so a frame loop can spread the work over idle frames;
+    # start() hands the mode's board to a new GameState, finishing it there
+    # and then if it isn't ready yet
+    def __init__(self):
+        # (rows, cols) -> [seed, rng, work, grid], classic board first
+        self.slots = {size: [None, None, None, None]
+                      for size in [(GRID_ROWS, GRID_COLS)] + list(BOARD_SIZES.values())}
+
+    def step(self):
+        # does one slice of work on the first board still being built; True
+        # once every size has a board waiting
+        for size, slot in self.slots.items():
+            if slot[3] is None:
+                self.advance(size)
+                return False
+        return True
+
+    def advance(self, size):
+        slot = self.slots[size]
+        if slot[2] is None:
+            slot[0] = random.getrandbits(64)
+            slot[1] = random.Random(slot[0])
+            slot[2] = build_grid(no_start_matches=True, rng=slot[1], rows=size[0], cols=size[1])
+        slot[3] = next(slot[2])
+        if slot[3] is not None:
+            slot[2] = None
+
+    def start(self, difficulty="Free Play", **options):
+        size = board_size(difficulty)
+        if size not in self.slots:
+            return GameState(difficulty, **options)
+        slot = self.slots[size]
+        while slot[3] is None:
+            self.advance(size)
+        # the rng has drawn exactly what create_grid would have, so the game
+        # replays from its seed like any other
+        game = GameState(difficulty, seed=slot[0], rng=slot[1], grid=slot[3], **options)
+        slot[:] = [None, None, None, None]
+        return game
+
+# swaps a practice game can take back; older snapshots are dropped
+UNDO_LIMIT = 100
+
+
+class Snapshot:
+    # everything a GameState needs to be put back to an earlier move. The
+    # fields are immutable (cells as bytes, the rng state as the tuple
+    # getstate() makes), so a snapshot is shared rather than copied by the
+    # undo and redo stacks and by restore(). The spawn tier follows from the
+    # score; the clock isn't part of it and keeps running
+    __slots__ = ("cells", "score", "bomb_time", "bombs_unlocked", "bomb_pool", "rng", "timer_start",
+                 "swaps", "over", "end")
+
+    def __init__(self, game):
+        self.cells = bytes(game.grid.cells)
+        self.score = game.score
+        self.bomb_time = game.bomb_time
+        self.bombs_unlocked = game.bombs_unlocked
+        self.bomb_pool = tuple(game.bomb_pool)
+        self.rng = game.rng.getstate()
+        self.timer_start = game.timer_start
+        self.swaps = game.swaps
+        self.over = game.over
+        self.end = game.end
+
+
+class GameState:
+    # one game with no display attached. The clock only moves when step() is
+    # called and every random draw comes from rng, so a game seeded the same
+    # way and fed the same swaps at the same times plays out identically
+    def __init__(self, difficulty="Free Play", seed=None, rng=None, grid=None, index_moves=True, reshuffle=False,
+                 practice=False):
+        if rng is None:
+            if seed is None:
+                seed = random.getrandbits(64)
+            rng = random.Random(seed)
+        self.seed = seed
+        self.rng = rng
+        self.difficulty = difficulty
+        self.duration = DIFFICULTY_SETTINGS.get(difficulty)
+        self.now = 0
+        self.timer_start = 0
+        if grid is None:
+            rows, cols = board_size(difficulty)
+            grid = create_grid(no_start_matches=True, rng=self.rng, rows=rows, cols=cols)
+        grid.index_colours()
+        self.grid = grid
+        # the move index is built on the first legal_moves() call, since a
+        # rebuild scans every swap; until then, and for good without
+        # index_moves, each settle asks has_moves, which stops at the first
+        # legal swap
+        self.index_moves = index_moves
+        self.moves = None
+        self.score = 0
+        self.bombs_unlocked = False
+        self.bomb_time = 0
+        self.bomb_pool = list(BOMB_INDICES)
+        # off for authored boards, which place all their own power-ups
+        self.cadence = True
+        # deal the board out again rather than end on "no more moves"
+        self.reshuffle = reshuffle
+        self.swaps = 0
+        # (tick, r1, c1, r2, c2) for every swap played, for replays
+        self.log = []
+        self.over = False
+        # "time" once the timer runs out, "moves" once no swap is left
+        self.end = None
+        # practice games keep a snapshot from before every swap so it can be
+        # taken back; redo_stack holds (snapshot, log entries) for each swap
+        # undo() stepped back over
+        self.history = [] if practice else None
+        self.redo_stack = []
+        self.undos = 0
+
+    def elapsed(self):
+        # whole seconds on the timer, bonuses included
+        return (self.now - self.timer_start) // 1000
+
+    def legal_moves(self):
+        if self.moves is None and self.index_moves:
+            self.moves = MoveIndex(self.grid)
+        if self.moves is not None:
+            return self.moves.list()
+        return scan_moves(self.grid)
+
+    def swap(self, r1, c1, r2, c2, record=False):
+        # the resolve_move result, or None when the swap can't be tried at all
+        return run_steps(self.swap_steps(r1, c1, r2, c2, record))
+
+    def swap_steps(self, r1, c1, r2, c2, record=False):
+        # swap() a cascade step at a time, for run_slice(). The game is only
+        # updated once the board settles, and the clock must not be stepped
+        # in between, so the log holds the tick a replay plays the swap at
+        grid = self.grid
+        if self.over or not are_adjacent((r1, c1), (r2, c2)):
+            return None
+        if not (0 <= min(r1, r2) and max(r1, r2) < grid.rows and 0 <= min(c1, c2) and max(c1, c2) < grid.cols):
+            return None
+        before = self.snapshot() if self.history is not None else None
+        result = yield from resolve_steps(grid, r1, c1, r2, c2, self.score, self.rng, self.bomb_time,
+                                          self.bombs_unlocked, self.moves, record, self.bomb_pool, self.cadence,
+                                          self.reshuffle)
+        if not result["accepted"]:
+            return result
+        if before is not None:
+            self.history.append(before)
+            if len(self.history) > UNDO_LIMIT:
+                del self.history[0]
+            self.redo_stack.clear()
+        self.swaps += 1
+        self.log.append((self.now, r1, c1, r2, c2))
+        self.score = result["score"]
+        self.bomb_time = result["bomb_time"]
+        self.bombs_unlocked = result["bombs_unlocked"]
+        if self.duration:
+            for _ in range(result["steps"]):
+                self.timer_start = add_time(1, self.duration, self.timer_start, self.now)
+        if not result["moves"]:
+            self.over = True
+            self.end = "moves"
+        return result
+
+    def snapshot(self):
+        return Snapshot(self)
+
+    def restore(self, snap):
+        # back to a snapshot of this game; the log drops the swaps played
+        # since, and with the rng put back too, a replay of what is left
+        # still arrives at this same position
+        self.grid.restore(snap.cells)
+        self.score = snap.score
+        self.bomb_time = snap.bomb_time
+        self.bombs_unlocked = snap.bombs_unlocked
+        self.bomb_pool[:] = snap.bomb_pool
+        self.rng.setstate(snap.rng)
+        self.timer_start = snap.timer_start
+        del self.log[snap.swaps:]
+        self.swaps = snap.swaps
+        self.over = snap.over
+        self.end = snap.end
+
+    def undo(self):
+        # takes back the last swap of a practice game; False if there is none
+        if not self.history:
+            return False
+        snap = self.history.pop()
+        self.redo_stack.append((self.snapshot(), self.log[snap.swaps:]))
+        self.restore(snap)
+        self.undos += 1
+        return True
+
+    def redo(self):
+        # puts back the last swap undo() took, log entry and all
+        if not self.redo_stack:
+            return False
+        snap, moves = self.redo_stack.pop()
+        self.history.append(self.snapshot())
+        self.restore(snap)
+        self.log += moves
+        return True
+
+    def step(self, ms):
+        self.now += ms
+        if not self.over and self.duration and self.elapsed() >= self.duration:
+            self.over = True
+            self.end = "time"
+
+    def is_over(self):
+        return self.over
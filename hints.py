@@ -0,0 +1,338 @@
+import argparse
+import random
+import sys
+import time
+import zlib
+from collections import OrderedDict
+
+import engine
+from engine import GameState, detonation_mask, find_match_groups, resolve_move, score_for_chain, would_match_after_swap
+
+# move hints: ranks the legal swaps by the points they are expected to bring
+# over a few moves of lookahead. Refills are random, so every swap is a chance
+# node averaged over a handful of sampled refills; each sample draws from an
+# rng seeded by the position, so a position always sees the same refills and
+# its value can be cached in a transposition table keyed by Zobrist hash.
+#
+# The search is a generator stepped by run(budget_ms), so a frame loop can
+# give it a few milliseconds a frame and show the best hint found so far.
+# Boards bigger than LOOKAHEAD_CELLS only get the immediate-points ranking:
+# on a 64x64 board a move scan or a Zobrist hash alone takes tens of
+# milliseconds, so lookahead there could never fit a frame's slice.
+
+HINT_DEPTH = 2
+HINT_SAMPLES = 3
+HINT_BUDGET_MS = 5
+# how fast run() forgets a long step when judging whether the next one fits
+STEP_DECAY = 0.99
+# run() leaves room for this many of the longest recent step, as step times
+# vary with the cascades they play out
+STEP_MARGIN = 2
+TABLE_SIZE = 50000
+LOOKAHEAD_CELLS = 256
+# a refill that leaves no swap ends the game, which costs more than any clear
+NO_MOVES_PENALTY = 1000
+
+ZOBRIST_KEYS = {}
+
+
+def zobrist_keys(size):
+    # one random 64-bit key per (cell, tile), fixed so hashes are stable
+    keys = ZOBRIST_KEYS.get(size)
+    if keys is None:
+        rng = random.Random(f"zobrist/{size}")
+        keys = [rng.getrandbits(64) for _ in range(size * 256)]
+        ZOBRIST_KEYS[size] = keys
+    return keys
+
+
+def zobrist(grid):
+    cells = grid.cells
+    keys = zobrist_keys(len(cells))
+    h = 0
+    for i, v in enumerate(cells):
+        h ^= keys[i << 8 | v]
+    return h
+
+
+def rehash(h, grid, point):
+    # the hash after the moves made since checkpoint point, from the hash
+    # before them: only the cells the journal saw written are rekeyed
+    journal = grid.journal
+    cells = grid.cells
+    keys = zobrist_keys(len(cells))
+    seen = set()
+    for k in range(point, len(journal), 2):
+        i = journal[k]
+        if i not in seen:
+            seen.add(i)
+            h ^= keys[i << 8 | journal[k + 1]] ^ keys[i << 8 | cells[i]]
+    return h
+
+
+class TranspositionTable:
+    # position values by (hash, rules key, depth), least recently used
+    # entries dropped first once it holds capacity of them
+    def __init__(self, capacity=TABLE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+# shared by default so hints later in a game reuse what earlier ones found
+TABLE = TranspositionTable()
+
+
+def immediate_points(grid, move, rng):
+    # points the first clear of a move is worth, without its cascade
+    (r1, c1), (r2, c2) = move
+    a = grid.get(r1, c1)
+    b = grid.get(r2, c2)
+    fa = engine.TILE_FLAGS[a]
+    fb = engine.TILE_FLAGS[b]
+    if fa & engine.TILE_COLOUR_CLEAR and fb & engine.TILE_NORMAL:
+        return score_for_chain(grid.count(b) + 1)
+    if fb & engine.TILE_COLOUR_CLEAR and fa & engine.TILE_NORMAL:
+        return score_for_chain(grid.count(a) + 1)
+    if (fa | fb) & engine.TILE_BOMB:
+        if (fa | fb) & engine.TILE_SNAKE and not (fa & fb & engine.TILE_BOMB):
+            return 0
+        fired = []
+        if fa & engine.TILE_BOMB:
+            fired.append((a, r2 * grid.cols + c2))
+        if fb & engine.TILE_BOMB:
+            fired.append((b, r1 * grid.cols + c1))
+        return score_for_chain(bin(detonation_mask(grid, fired, rng)).count("1"))
+    probe = grid.copy()
+    probe.swap(r1, c1, r2, c2)
+    return sum(score_for_chain(g["size"]) for g in find_match_groups(probe, {r1, r2}, {c1, c2}))
+
+
+def legal_moves(grid):
+    rows, cols = grid.rows, grid.cols
+    return [((r, c), (r2, c2)) for r in range(rows) for c in range(cols)
+            for (r2, c2) in ((r, c + 1), (r + 1, c))
+            if r2 < rows and c2 < cols and would_match_after_swap(grid, r, c, r2, c2)]
+
+
+def legal_moves_by_row(grid):
+    # legal_moves a row at a time, for searches that yield between rows
+    rows, cols = grid.rows, grid.cols
+    for r in range(rows):
+        yield [((r, c), (r2, c2)) for c in range(cols)
+               for (r2, c2) in ((r, c + 1), (r + 1, c))
+               if r2 < rows and c2 < cols and would_match_after_swap(grid, r, c, r2, c2)]
+
+
+def spawn_tier(score):
+    return next(t for t in engine.SPAWN_TIERS if score >= t)
+
+
+def rules_key(state):
+    # everything besides the cells that changes how a swap can play out: the
+    # spawn tier, which unlock thresholds the score has passed, and the bomb
+    # cadence and pool
+    score, bomb_time, bombs_unlocked, bomb_pool = state
+    return (spawn_tier(score), score >= engine.BOMB_UNLOCK_SCORE, score >= engine.SNAKE_UNLOCK_SCORE,
+            bomb_time, bombs_unlocked, tuple(bomb_pool))
+
+
+class HintSearch:
+    # ranking is [(expected points, move)] best first, from the deepest
+    # lookahead finished so far; done is set once depth has been searched
+    def __init__(self, grid, score=0, bomb_time=0, bombs_unlocked=False, bomb_pool=None,
+                 depth=HINT_DEPTH, samples=HINT_SAMPLES, table=TABLE):
+        # the one board the search plays on, rewound after every sample
+        self.board = grid.copy()
+        self.score = score
+        self.bomb_time = bomb_time
+        self.bombs_unlocked = bombs_unlocked
+        self.bomb_pool = list(engine.BOMB_INDICES if bomb_pool is None else bomb_pool)
+        self.depth = depth if len(self.board.cells) <= LOOKAHEAD_CELLS else 0
+        self.samples = samples
+        self.table = table
+        self.ranking = []
+        self.searched = 0
+        self.done = False
+        self.nodes = 0
+        # Zobrist hash of the board as it stands, carried through make/unmake
+        self.hash = None
+        # how long the last step of the search took, in seconds
+        self.last_step = 0
+        self.work = self.search()
+
+    @classmethod
+    def for_game(cls, game, **options):
+        return cls(game.grid, game.score, game.bomb_time, game.bombs_unlocked, game.bomb_pool, **options)
+
+    def run(self, budget_ms=HINT_BUDGET_MS):
+        # searches until another step or two as long as the longest recent
+        # one would overrun the budget, or the search is done, then returns the best hint so
+        # far; the first step always runs so every slice makes progress
+        began = now = time.perf_counter()
+        deadline = began + budget_ms / 1000
+        while not self.done:
+            if now > began and now + STEP_MARGIN * self.last_step > deadline:
+                break
+            try:
+                next(self.work)
+            except StopIteration:
+                self.done = True
+            after = time.perf_counter()
+            # a long step is remembered for a while, since the next one is
+            # often another cascade of the same size
+            self.last_step = max(after - now, self.last_step * STEP_DECAY)
+            now = after
+        return self.best()
+
+    def finish(self):
+        while not self.done:
+            self.run(1000)
+        return self.best()
+
+    def best(self):
+        return self.ranking[0][1] if self.ranking else None
+
+    def search(self):
+        # iterative deepening: immediate points first, which also orders the
+        # moves so a cut-off search has looked at the likeliest ones first.
+        # Both passes yield as they go, since on a big board either one
+        # takes many frames' worth of time
+        board = self.board
+        moves = []
+        for row in legal_moves_by_row(board):
+            moves += row
+            yield
+        # only a board that is searched deeper needs the Zobrist hash
+        if self.depth:
+            self.hash = zobrist(board)
+            yield
+        rng = random.Random(self.hash if self.depth else zlib.crc32(board.cells))
+        ranking = []
+        for move in moves:
+            ranking.append((immediate_points(board, move, rng), move))
+            yield
+        ranking.sort(key=lambda e: -e[0])
+        self.ranking = ranking
+        state = (self.score, self.bomb_time, self.bombs_unlocked, self.bomb_pool)
+        for depth in range(1, self.depth + 1):
+            ranking = []
+            for _, move in self.ranking:
+                value = yield from self.expected(state, move, depth)
+                ranking.append((value, move))
+            ranking.sort(key=lambda e: -e[0])
+            self.ranking = ranking
+            self.searched = depth
+
+    def expected(self, state, move, depth):
+        # chance node: the mean over sampled refills of what the swap scores
+        # plus the best that can follow it
+        score, bomb_time, bombs_unlocked, bomb_pool = state
+        board = self.board
+        (r1, c1), (r2, c2) = move
+        h = self.hash
+        seed = h ^ (r1 * board.cols + c1) << 1 ^ (r2 != r1)
+        total = 0
+        for sample in range(self.samples):
+            point = board.checkpoint()
+            pool = list(bomb_pool)
+            result = resolve_move(board, r1, c1, r2, c2, score, random.Random(seed + sample),
+                                  bomb_time, bombs_unlocked, record=False, bomb_pool=pool)
+            self.nodes += 1
+            yield
+            value = result["points"]
+            if not result["moves"]:
+                value -= NO_MOVES_PENALTY
+            elif depth > 1:
+                after = (result["score"], result["bomb_time"], result["bombs_unlocked"], pool)
+                self.hash = rehash(h, board, point)
+                value += yield from self.value(after, depth - 1)
+                self.hash = h
+            board.rewind(point)
+            total += value
+        return total / self.samples
+
+    def value(self, state, depth):
+        # max node: the best expected points of any swap from here
+        key = (self.hash, rules_key(state), depth)
+        best = self.table.get(key)
+        if best is not None:
+            return best
+        best = -NO_MOVES_PENALTY
+        for row in legal_moves_by_row(self.board):
+            yield
+            for move in row:
+                value = yield from self.expected(state, move, depth)
+                if value > best:
+                    best = value
+        self.table.put(key, best)
+        return best
+
+
+def best_hint(game, budget_ms=None, **options):
+    # the top hint for a GameState, searched to the end unless a budget is set
+    search = HintSearch.for_game(game, **options)
+    return search.finish() if budget_ms is None else search.run(budget_ms)
+
+
+def check_slices(boards=20, budget_ms=HINT_BUDGET_MS, difficulty="Easy", seed=0):
+    # times every run(budget_ms) slice of full searches from seeded positions
+    # part way into random games, as a frame loop would drive them
+    times = []
+    for n in range(boards):
+        game = GameState(difficulty, seed=f"{seed}/{n}")
+        rng = random.Random(f"{seed}/{n}/moves")
+        for _ in range(n * 3):
+            if game.is_over():
+                break
+            moves = game.legal_moves()
+            move = moves[rng.randrange(len(moves))]
+            game.swap(*move[0], *move[1])
+        search = HintSearch.for_game(game, table=TranspositionTable())
+        while not search.done:
+            began = time.perf_counter()
+            search.run(budget_ms)
+            times.append((time.perf_counter() - began) * 1000)
+    return sorted(times)
+
+
+def main(argv=None):
+    # python hints.py [--boards N] [--budget MS]: checks the search keeps to
+    # its frame slice; fails when the 99th percentile slice is over budget
+    parser = argparse.ArgumentParser(description="Time the hint search's frame slices against their budget.")
+    parser.add_argument("--boards", type=int, default=20)
+    parser.add_argument("--budget", type=float, default=HINT_BUDGET_MS, help="slice budget in ms")
+    parser.add_argument("--difficulty", default="Easy", choices=list(engine.DIFFICULTY_SETTINGS))
+    parser.add_argument("--seed", default="0")
+    args = parser.parse_args(argv)
+
+    times = check_slices(args.boards, args.budget, args.difficulty, args.seed)
+    n = len(times)
+    p99 = times[min(n - 1, n * 99 // 100)]
+    over = sum(1 for t in times if t > args.budget)
+    print(f"{n} slices of {args.budget} ms: p50 {times[n // 2]:.2f} p99 {p99:.2f} max {times[-1]:.2f} ms,"
+          f" {over} over budget")
+    return 0 if p99 <= args.budget else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
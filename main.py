@@ -1,29 +1,34 @@
 import os
 import sys
+import time
 import random
 import asyncio
+import argparse
+import traceback
 import pygame
 from pygame.locals import *
 import json
+from collections import OrderedDict
+from engine import *
+import replay
+from hints import HINT_BUDGET_MS, HintSearch
+import puzzle
 
 
 WINDOW_SIZE = 1000,1000
 BOARD_SIZE = 800, 800
-GRID_COLS = 9
-GRID_ROWS = 9
 CELL_SIZE = BOARD_SIZE[0] // GRID_COLS
 BOARD_OFFSET = ((WINDOW_SIZE[0] - BOARD_SIZE[0]) // 2, (WINDOW_SIZE[1] - BOARD_SIZE[1]) // 2)
+# top left of the cells, which set_board_size() centres in the board
+GRID_ORIGIN = (BOARD_OFFSET[0] + (BOARD_SIZE[0] - GRID_COLS * CELL_SIZE) // 2,
+               BOARD_OFFSET[1] + (BOARD_SIZE[1] - GRID_ROWS * CELL_SIZE) // 2)
+# the cell size the drawing insets and corner radii were made for
+CLASSIC_CELL_SIZE = CELL_SIZE
 FPS = 60
 SNAKE_STEP_DELAY_MS = 120
 
 MENU, PLAYING, GAME_OVER = 0, 1, 2
 game_state = MENU
-DIFFICULTY_SETTINGS = {
-    "Easy": 150,
-    "Normal": 110,
-    "Hard": 60,
-    "Free Play": None
-}
 current_difficulty = None
 timer_duration = None
 timer_start = None
@@ -32,16 +37,10 @@ font_path = os.path.join("fonts","orbitron-black.otf")
 
 POP_FOLDER = os.path.join("pops")
 BUBBLE_FOLDER = os.path.join("bubbles") 
-BUBBLE_NAMES = [f"bubble{i}" for i in range(1, 10)]
-SPECIAL_BUBBLE_INDEX = 6
-SPECIAL_BUBBLE2_INDEX = 7
-SPECIAL_BUBBLE3_INDEX = 8
 IMG_EXTS = [".png", ".jpg", ".jpeg"]
 POWERUP_FOLDERS =[os.path.join("power up"), os.path.join("bombs")]
 SNAKE_NAME = "snake"
-SNAKE_INDEX = None
 BOMB_FOLDER = os.path.join("bombs")
-BOMB_NAMES = ["bomb1", "bomb2", "bomb3"]
 
 OVERLAY_PATHS = {
     "board": {
@@ -58,11 +57,22 @@ OVERLAY_PATHS = {
     },
 }
 OVERLAY_CACHE = {key: {} for key in OVERLAY_PATHS}
+# baked layers by (name, skin, screen size[, board size]), and the game over
+# shade by screen size; see overlay_layer() and board_layers()
+LAYER_CACHE = {}
+# overlays are cut into tiles this size, and along the board's edges, so the
+# transparent ones are skipped and the opaque ones copied without blending
+LAYER_TILE = 125
+# rendered text by (font, text, colour), least recently used dropped first
+# once it holds TEXT_CACHE_SIZE of them; see render_text()
+TEXT_CACHE = OrderedDict()
+TEXT_CACHE_SIZE = 256
+# tile images by cell size
+TILE_IMAGES = {}
 
 HIGHLIGHT_DELAY_MS = 600
 FONT_NAME = None
 SCORE_PER_CHAIN = 10
-
 HIGHSCORE_FILE = os.path.join("highscores.txt")
 
 BG_COLOR = (18, 18, 22)
@@ -72,6 +82,7 @@ HL_COLOR_3 = (120, 200, 255)
 HL_COLOR_4 = (120, 255, 120)
 HL_COLOR_5PLUS = (255, 150, 80)
 HL_BOMB = (255,100,100)
+HINT_COLOR = (255, 230, 120)
 T_COLOR = (180,80,220)
 
 SCORE_COLOR = (237, 211, 119)
@@ -88,6 +99,8 @@ button_sound_file = os.path.join("jsounds", "button.ogg")
 snake_sound_file = os.path.join("jsounds", "snake.ogg")
 skin = 1
 IS_WEB = sys.platform == "emscripten"
+# off while autoplay soaks the game, so bots don't touch the player's files
+KEEP_RECORDS = True
 
 def load_font_safe(path, size, label):
     try:
@@ -130,6 +143,8 @@ def load_highscores():
         return {diff: 0 for diff in DIFFICULTY_SETTINGS.keys()}
 
 def save_highscore(difficulty, score):
+    if not KEEP_RECORDS:
+        return
     highscores = load_highscores()
     if score > highscores.get(difficulty, 0):
         highscores[difficulty] = score
@@ -139,6 +154,19 @@ def save_highscore(difficulty, score):
         except Exception:
             pass
 
+def get_replay_file():
+    return os.path.join(os.path.dirname(get_highscore_file()), "last_game.replay")
+
+def save_replay(game):
+    # undo rewinds the log and the rng, so a practice game that used it would
+    # replay as a clean game played with the refills already known
+    if not KEEP_RECORDS or not game.log or game.undos:
+        return
+    try:
+        replay.save(get_replay_file(), replay.Replay.from_game(game))
+    except Exception as e:
+        print("Error saving replay:", e)
+
 def load_bomb_images():
     imgs = []
     for name in BOMB_NAMES:
@@ -153,7 +181,9 @@ def load_bomb_images():
                     pass
         if img is None:
             surf = pygame.Surface((CELL_SIZE, CELL_SIZE), pygame.SRCALPHA)
-            pygame.draw.rect(surf, (220, 80, 80), (8, 8, CELL_SIZE-16, CELL_SIZE-16), border_radius=8)
+            inset = scaled(8)
+            pygame.draw.rect(surf, (220, 80, 80), (inset, inset, CELL_SIZE - 2 * inset, CELL_SIZE - 2 * inset),
+                             border_radius=scaled(8))
             imgs.append(surf)
         else:
             imgs.append(pygame.transform.smoothscale(img, (CELL_SIZE, CELL_SIZE)))
@@ -182,23 +212,122 @@ def load_scaled_overlay(path, size):
 
 
 def preload_overlays(target_size):
+    # loads and bakes every skin's overlays, so switching skins never stalls
+    # a frame
     for key, variants in OVERLAY_PATHS.items():
-        cached = OVERLAY_CACHE.setdefault(key, {})
-        for skin_id, path in variants.items():
-            if skin_id not in cached:
-                cached[skin_id] = load_scaled_overlay(path, target_size)
+        for skin_id in variants:
+            overlay_layer(key, skin_id, target_size)
+
+
+def overlay_image(key, skin_id, size):
+    cached = OVERLAY_CACHE.setdefault(key, {})
+    if skin_id not in cached:
+        cached[skin_id] = load_scaled_overlay(OVERLAY_PATHS[key][1 if skin_id == 1 else 2], size)
+    img = cached[skin_id]
+    if img is not None and img.get_size() != size:
+        img = pygame.transform.smoothscale(img, size)
+    return img
+
+
+def layer_tiles(size):
+    # rects covering the screen, cut every LAYER_TILE and along the board's
+    # edges so each one is wholly on or off the board
+    board = pygame.Rect(BOARD_OFFSET, BOARD_SIZE)
+    w, h = size
+    xs = sorted({0, w, *range(0, w, LAYER_TILE), *(min(max(x, 0), w) for x in (board.left, board.right))})
+    ys = sorted({0, h, *range(0, h, LAYER_TILE), *(min(max(y, 0), h) for y in (board.top, board.bottom))})
+    return [pygame.Rect(x0, y0, x1 - x0, y1 - y0) for y0, y1 in zip(ys, ys[1:]) for x0, x1 in zip(xs, xs[1:])]
+
+
+def bake_overlay(img):
+    # (surface, pos) pairs for blits() that draw img: fully transparent tiles
+    # are left out, the rest cropped to what they cover, and the fully opaque
+    # ones converted to plain surfaces, which blit as a copy
+    layer = []
+    for rect in layer_tiles(img.get_size()):
+        part = img.subsurface(rect)
+        bound = part.get_bounding_rect()
+        if not bound.w or not bound.h:
+            continue
+        part = part.subsurface(bound)
+        if pygame.mask.from_surface(part, 254).count() == bound.w * bound.h:
+            part = part.convert()
+        else:
+            part = part.copy()
+        layer.append((part, (rect.x + bound.x, rect.y + bound.y)))
+    return layer
+
+
+def overlay_layer(key, skin_id, size):
+    layer = LAYER_CACHE.get((key, skin_id, size))
+    if layer is None:
+        img = overlay_image(key, skin_id, size)
+        layer = LAYER_CACHE[(key, skin_id, size)] = bake_overlay(img) if img is not None else []
+    return layer
+
+
+def menu_layer(surface):
+    # the menu's background and overlay composited into one opaque surface
+    size = surface.get_size()
+    layer = LAYER_CACHE.get(("menu base", skin, size))
+    if layer is None:
+        layer = pygame.Surface(size)
+        layer.fill(BG_COLOR)
+        layer.blits(overlay_layer("menu", skin, size), False)
+        LAYER_CACHE[("menu base", skin, size)] = layer
+    return layer
 
 
-def draw_menu(surface, font_big, font_medium, skin):
+def board_layers(surface):
+    # what draw_board puts under the cells and over them. Under is one opaque
+    # surface: the background, the board, its grid lines and the board
+    # overlay's tiles off the board, which nothing drawn on the board reaches.
+    # Over is the rest of the overlay, blended on top of the cells
+    size = surface.get_size()
+    key = ("board", skin, size, GRID_ROWS, GRID_COLS)
+    layers = LAYER_CACHE.get(key)
+    if layers is None:
+        board = pygame.Rect(BOARD_OFFSET, BOARD_SIZE)
+        under = pygame.Surface(size)
+        under.fill(BG_COLOR)
+        pygame.draw.rect(under, GRID_BG, board)
+        left, top = GRID_ORIGIN
+        right = left + GRID_COLS * CELL_SIZE
+        bottom = top + GRID_ROWS * CELL_SIZE
+        for i in range(GRID_COLS + 1):
+            x = left + i * CELL_SIZE
+            pygame.draw.line(under, GRID_LINE, (x, top), (x, bottom))
+        for j in range(GRID_ROWS + 1):
+            y = top + j * CELL_SIZE
+            pygame.draw.line(under, GRID_LINE, (left, y), (right, y))
+        overlay = overlay_layer("board", skin, size)
+        under.blits([tile for tile in overlay if not board.collidepoint(tile[1])], False)
+        layers = LAYER_CACHE[key] = (under, [tile for tile in overlay if board.collidepoint(tile[1])])
+    return layers
+
+
+def render_text(font, text, color):
+    key = (font, text, color)
+    surf = TEXT_CACHE.get(key)
+    if surf is None:
+        surf = TEXT_CACHE[key] = font.render(text, True, color)
+        if len(TEXT_CACHE) > TEXT_CACHE_SIZE:
+            TEXT_CACHE.popitem(last=False)
+    else:
+        TEXT_CACHE.move_to_end(key)
+    return surf
+
+
+def draw_menu(surface, font_big, font_medium, skin, reshuffle=False):
     draw_overlaytmenu(surface)
     if skin == 1:
-        title = font_big.render("Difficulty", True, T_COLOR)
-        title1 = font_medium.render("Press R To", True, T_COLOR)
-        title2 = font_medium.render("Restart", True, T_COLOR)
+        title = render_text(font_big, "Difficulty", T_COLOR)
+        title1 = render_text(font_medium, "Press R To", T_COLOR)
+        title2 = render_text(font_medium, "Restart", T_COLOR)
     else:
-        title = font_big.render("Difficulty", True, SCORE_COLOR)
-        title1 = font_medium.render("Press R To", True, SCORE_COLOR)
-        title2 = font_medium.render("Restart", True, SCORE_COLOR)
+        title = render_text(font_big, "Difficulty", SCORE_COLOR)
+        title1 = render_text(font_medium, "Press R To", SCORE_COLOR)
+        title2 = render_text(font_medium, "Restart", SCORE_COLOR)
     rect = title.get_rect(center=(WINDOW_SIZE[0]//2, 300))
     surface.blit(title, rect)
     rect1 = title1.get_rect(center=(WINDOW_SIZE[0]//2, 750))
@@ -206,44 +335,57 @@ def draw_menu(surface, font_big, font_medium, skin):
     rect2 = title2.get_rect(center=(WINDOW_SIZE[0]//2, 790))
     surface.blit(title2, rect2)
 
-    title3 = font_medium.render("Press", True, (30,30,30))
-    title4 = font_medium.render("M to Mute", True, (30,30,30))
+    title3 = render_text(font_medium, "Press", (30,30,30))
+    title4 = render_text(font_medium, "M to Mute", (30,30,30))
     rect3 = title3.get_rect(center=(WINDOW_SIZE[0]//2, 900))
     surface.blit(title3, rect3)
     rect4 = title4.get_rect(center=(WINDOW_SIZE[0]//2, 940))
     surface.blit(title4, rect4)
-
-    buttons = []
-    labels = ["Easy", "Normal", "Hard", "Free Play"]
-    for i, text in enumerate(labels):
-        btn_text = font_medium.render(text, True, (30,30,30))
-        btn_rect = pygame.Rect(WINDOW_SIZE[0]//2 - 150, 350 + i*100, 300, 60)
+    title5 = render_text(font_medium, "P for Puzzles", (30,30,30))
+    rect5 = title5.get_rect(center=(WINDOW_SIZE[0]//2, 980))
+    surface.blit(title5, rect5)
+    title6 = render_text(font_medium, f"S Reshuffle: {'On' if reshuffle else 'Off'}", (30,30,30))
+    rect6 = title6.get_rect(center=(WINDOW_SIZE[0]//2, 220))
+    surface.blit(title6, rect6)
+
+    buttons = menu_buttons()
+    for btn_rect, text in buttons:
+        btn_text = render_text(font_medium, text, (30,30,30))
         surface.blit(btn_text, btn_text.get_rect(center=btn_rect.center))
-        buttons.append((btn_rect, text))
 
     return buttons
 
+def menu_buttons():
+    labels = list(DIFFICULTY_SETTINGS)
+    return [(pygame.Rect(WINDOW_SIZE[0]//2 - 150, 340 + i*80, 300, 60), text) for i, text in enumerate(labels)]
+
+# the full timer bar; the drawn bar shrinks from the right inside it
+TIMER_RECT = pygame.Rect(50, WINDOW_SIZE[1] - 80, WINDOW_SIZE[0] - 100, 20)
+
 def draw_timer(surface, elapsed, duration, timer_color):
     if duration is None:
-        width = WINDOW_SIZE[0] - 100
+        width = TIMER_RECT.w
     else:
         remaining = max(0, duration - elapsed)
         fraction = remaining / duration
-        width = int((WINDOW_SIZE[0] - 100) * fraction)
+        width = int(TIMER_RECT.w * fraction)
 
-    bar_rect = pygame.Rect(50, WINDOW_SIZE[1] - 80, width, 20)
+    bar_rect = pygame.Rect(TIMER_RECT.topleft, (width, TIMER_RECT.h))
     pygame.draw.rect(surface, (timer_color), bar_rect, border_radius=2)
 
-def add_time(seconds, timer_duration, timer_start):
-    timer_start += seconds * (timer_duration*15 )
-    if timer_duration:
-        now = pygame.time.get_ticks()
-        elapsed = (now - timer_start) // 1000
-        remaining = timer_duration - elapsed
-        if remaining > timer_duration:
-            timer_start = now - (0 * 1000)
-    return timer_start
+def draw_puzzle_status(surface, font, game):
+    goal = game.puzzle
+    parts = []
+    if goal.blockers:
+        parts.append(f"Blockers {game.grid.count(SPECIAL_BUBBLE_INDEX)}")
+    if goal.target:
+        parts.append(f"Score {game.score}/{goal.target}")
+    text = render_text(font, f"{goal.name}  |  Moves {game.moves_left()}  |  " + "  ".join(parts), SCORE_COLOR)
+    surface.blit(text, text.get_rect(center=(WINDOW_SIZE[0]//2, WINDOW_SIZE[1] - 70)))
 
+def draw_practice_status(surface, font, game):
+    text = render_text(font, f"U Undo ({len(game.history)})  |  Y Redo ({len(game.redo_stack)})", SCORE_COLOR)
+    surface.blit(text, text.get_rect(center=(WINDOW_SIZE[0]//2, WINDOW_SIZE[1] - 110)))
 
 def load_bubble_images():
     images = []
@@ -260,327 +402,66 @@ def load_bubble_images():
                     pass
         if img is None:
             surf = pygame.Surface((CELL_SIZE, CELL_SIZE), pygame.SRCALPHA)
-            color = [random.randint(80, 230) for _ in range(3)]
-            pygame.draw.circle(surf, color, (CELL_SIZE//2, CELL_SIZE//2), CELL_SIZE//2 - 8)
+            # seeded by name so a missing image keeps its colour between runs
+            shade = random.Random(name)
+            color = [shade.randint(80, 230) for _ in range(3)]
+            pygame.draw.circle(surf, color, (CELL_SIZE//2, CELL_SIZE//2), CELL_SIZE//2 - scaled(8))
             images.append(surf)
         else:
             images.append(pygame.transform.smoothscale(img, (CELL_SIZE, CELL_SIZE)))
     return images
 
 def load_all_images():
-    global SNAKE_INDEX
     bubble_imgs = load_bubble_images()
     bomb_imgs   = load_bomb_images()
     images = bubble_imgs + bomb_imgs
-    BOMB_INDICES = list(range(len(bubble_imgs), len(bubble_imgs) + len(bomb_imgs)))
+    bomb_indices = list(range(len(bubble_imgs), len(bubble_imgs) + len(bomb_imgs)))
     snake_img = load_snake_image()
     if snake_img is not None:
         images.append(snake_img)
-        SNAKE_INDEX = len(images) - 1
+        snake_index = len(images) - 1
     else:
-        SNAKE_INDEX = None
+        snake_index = None
+    configure_tiles(bomb_indices, snake_index)
 
-    return images, BOMB_INDICES
+    return images, bomb_indices
 
-def in_bounds(r, c):
-    return 0 <= r < GRID_ROWS and 0 <= c < GRID_COLS
+def tile_images():
+    # the tile images at the current cell size, loaded once per size
+    images = TILE_IMAGES.get(CELL_SIZE)
+    if images is None:
+        images, _ = load_all_images()
+        TILE_IMAGES[CELL_SIZE] = images
+    return images
+
+def set_board_size(rows, cols):
+    # cells as large as fit the board, centred in it; the insets and radii
+    # drawn around cells follow through scaled()
+    global GRID_ROWS, GRID_COLS, CELL_SIZE, GRID_ORIGIN
+    GRID_ROWS, GRID_COLS = rows, cols
+    CELL_SIZE = min(BOARD_SIZE[0] // cols, BOARD_SIZE[1] // rows)
+    GRID_ORIGIN = (BOARD_OFFSET[0] + (BOARD_SIZE[0] - cols * CELL_SIZE) // 2,
+                   BOARD_OFFSET[1] + (BOARD_SIZE[1] - rows * CELL_SIZE) // 2)
+
+def scaled(px):
+    # a length drawn for the classic board's cells, at the current cell size
+    return max(1, px * CELL_SIZE // CLASSIC_CELL_SIZE)
 
 def grid_to_px(r, c):
-    x = BOARD_OFFSET[0] + c * CELL_SIZE
-    y = BOARD_OFFSET[1] + r * CELL_SIZE
+    x = GRID_ORIGIN[0] + c * CELL_SIZE
+    y = GRID_ORIGIN[1] + r * CELL_SIZE
     return x, y
 
-def random_cell(score=0):
-    if score < 1000:
-        return random.randrange(0, len(BUBBLE_NAMES) - 1)
-    else:
-        pool = list(range(len(BUBBLE_NAMES) - 1)) * 10
-        pool.append(SPECIAL_BUBBLE_INDEX)
-        return random.choice(pool)
+def chain_label_center(group):
+    # a highlighted group's "x{n}" label sits on its lowest, rightmost corner cell
+    x, y = grid_to_px(max(r for r, c in group), max(c for r, c in group))
+    return x + CELL_SIZE // 2, y + CELL_SIZE // 2
 
-def create_grid(no_start_matches=True):
-    grid = [[pick_random_cell(0) for _ in range(GRID_COLS)] for _ in range(GRID_ROWS)]
+def draw_board(surface, grid, images, font, selection=None, highlight_groups=None, chain_sizes=None, hint=None):
+    under, over = board_layers(surface)
+    surface.blit(under, (0, 0))
+    left, top = GRID_ORIGIN
 
-    if no_start_matches:
-        while True:
-            matches = find_all_matches_wild_any(grid)
-            if not matches:
-                break
-            for group in matches:
-                for (r, c) in group:
-                    grid[r][c] = pick_random_cell()
-    return grid
-
-def pick_random_cell(score=0):
-    total = len(BUBBLE_NAMES)
-    specials = {SPECIAL_BUBBLE_INDEX}
-    try:
-        specials.add(SPECIAL_BUBBLE2_INDEX)
-    except NameError:
-        pass
-    try:
-        specials.add(SPECIAL_BUBBLE3_INDEX)
-    except NameError:
-        pass
-    normals = [i for i in range(total) if i not in specials]
-    pool = normals * 10
-    if score >= 1000:
-        pool.append(SPECIAL_BUBBLE_INDEX)
-    if 'SPECIAL_BUBBLE2_INDEX' in globals() and score >= 6000:
-        pool.append(SPECIAL_BUBBLE2_INDEX)
-    if 'SPECIAL_BUBBLE3_INDEX' in globals() and score >= 8000:
-        if random.random() < 0.25:
-            pool.append(SPECIAL_BUBBLE3_INDEX)
-    return random.choice(pool)
-
-
-def find_all_matches(grid):
-    groups = []
-    for r in range(GRID_ROWS):
-        c = 0
-        while c < GRID_COLS:
-            start = c
-            val = grid[r][c]
-            run = 1
-            c += 1
-            while c < GRID_COLS and grid[r][c] == val:
-                run += 1
-                c += 1
-            if run >= 3 and val is not None and val != SPECIAL_BUBBLE_INDEX and (SNAKE_INDEX is None or val != SNAKE_INDEX) and (('SPECIAL_BUBBLE2_INDEX' not in globals()) or val != SPECIAL_BUBBLE2_INDEX):
-                group = {(r, cc) for cc in range(start, start + run)}
-                groups.append(group)
-
-    for c in range(GRID_COLS):
-        r = 0
-        while r < GRID_ROWS:
-            start = r
-            val = grid[r][c]
-            run = 1
-            r += 1
-            while r < GRID_ROWS and grid[r][c] == val:
-                run += 1
-                r += 1
-            if run >= 3 and val is not None and val != SPECIAL_BUBBLE_INDEX and (SNAKE_INDEX is None or val != SNAKE_INDEX) and (('SPECIAL_BUBBLE2_INDEX' not in globals()) or val != SPECIAL_BUBBLE2_INDEX):
-                group = {(rr, c) for rr in range(start, start + run)}
-                groups.append(group)
-
-    return groups
-
-def find_all_matches_wild(grid):
-    groups = []
-
-    def is_wild(v):
-        return 'SPECIAL_BUBBLE2_INDEX' in globals() and v == SPECIAL_BUBBLE2_INDEX
-
-    def is_block(v):
-        if v is None:
-            return True
-        if v == SPECIAL_BUBBLE_INDEX:
-            return True
-        if 'SNAKE_INDEX' in globals() and SNAKE_INDEX is not None and v == SNAKE_INDEX:
-            return True
-        return False
-
-    for r in range(GRID_ROWS):
-        c = 0
-        while c < GRID_COLS:
-            run = []
-            base = None
-            while c < GRID_COLS:
-                v = grid[r][c]
-                if is_block(v):
-                    break
-                if is_wild(v):
-                    run.append((r, c))
-                    c += 1
-                    continue
-                if base is None:
-                    base = v
-                    run.append((r, c))
-                    c += 1
-                    continue
-                if v == base:
-                    run.append((r, c))
-                    c += 1
-                else:
-                    break
-            if len(run) >= 3:
-                groups.append(set(run))
-            if not run:
-                c += 1
-
-    for c in range(GRID_COLS):
-        r = 0
-        while r < GRID_ROWS:
-            run = []
-            base = None
-            while r < GRID_ROWS:
-                v = grid[r][c]
-                if is_block(v):
-                    break
-                if is_wild(v):
-                    run.append((r, c))
-                    r += 1
-                    continue
-                if base is None:
-                    base = v
-                    run.append((r, c))
-                    r += 1
-                    continue
-                if v == base:
-                    run.append((r, c))
-                    r += 1
-                else:
-                    break
-            if len(run) >= 3:
-                groups.append(set(run))
-            if not run:
-                r += 1
-
-    return groups
-
-def find_all_matches_wild_any(grid):
-    groups = []
-    total = len(BUBBLE_NAMES)
-    wild = SPECIAL_BUBBLE2_INDEX if 'SPECIAL_BUBBLE2_INDEX' in globals() else None
-
-    def is_block(v):
-        if v is None:
-            return True
-        if not isinstance(v, int):
-            return True
-        if v == SPECIAL_BUBBLE_INDEX:
-            return True
-        if 'SNAKE_INDEX' in globals() and SNAKE_INDEX is not None and v == SNAKE_INDEX:
-            return True
-        if 'SPECIAL_BUBBLE3_INDEX' in globals() and v == SPECIAL_BUBBLE3_INDEX:
-            return True
-        if v < 0 or v >= total:
-            return True
-        return False
-
-    def is_wild(v):
-        return wild is not None and v == wild
-
-    bases = [i for i in range(total) if i != SPECIAL_BUBBLE_INDEX and (wild is None or i != wild)]
-    for base in bases:
-        for r in range(GRID_ROWS):
-            c = 0
-            while c < GRID_COLS:
-                run = []
-                while c < GRID_COLS:
-                    v = grid[r][c]
-                    if is_block(v):
-                        break
-                    if v == base or is_wild(v):
-                        run.append((r, c))
-                        c += 1
-                    else:
-                        break
-                if len(run) >= 3:
-                    groups.append(set(run))
-                c = c + 1 if not run else c
-
-    for base in bases:
-        for c in range(GRID_COLS):
-            r = 0
-            while r < GRID_ROWS:
-                run = []
-                while r < GRID_ROWS:
-                    v = grid[r][c]
-                    if is_block(v):
-                        break
-                    if v == base or is_wild(v):
-                        run.append((r, c))
-                        r += 1
-                    else:
-                        break
-                if len(run) >= 3:
-                    groups.append(set(run))
-                r = r + 1 if not run else r
-
-    return groups
-
-def has_any_match(grid):
-    return len(find_all_matches_wild_any(grid)) > 0
-
-def apply_gravity_and_refill(grid, score):
-    for c in range(GRID_COLS):
-        write_row = GRID_ROWS - 1
-        for r in range(GRID_ROWS - 1, -1, -1):
-            if grid[r][c] is not None:
-                grid[write_row][c] = grid[r][c]
-                write_row -= 1
-        for r in range(write_row, -1, -1):
-            grid[r][c] = pick_random_cell(score)
-
-def would_match_after_swap(grid, r1, c1, r2, c2):
-    a = grid[r1][c1]
-    b = grid[r2][c2]
-
-    if 'BOMB_INDICES' in globals() and (a in BOMB_INDICES or b in BOMB_INDICES):
-        return True
-
-    if grid[r1][c1] == SPECIAL_BUBBLE_INDEX or grid[r2][c2] == SPECIAL_BUBBLE_INDEX:
-        return False
-
-    if 'SPECIAL_BUBBLE3_INDEX' in globals():
-        total = len(BUBBLE_NAMES)
-        def is_normal(v):
-            if v is None:
-                return False
-            if isinstance(v, int) and 0 <= v < total:
-                if v == SPECIAL_BUBBLE_INDEX:
-                    return False
-                if 'SPECIAL_BUBBLE2_INDEX' in globals() and v == SPECIAL_BUBBLE2_INDEX:
-                    return False
-                if 'SPECIAL_BUBBLE3_INDEX' in globals() and v == SPECIAL_BUBBLE3_INDEX:
-                    return False
-                if 'BOMB_INDICES' in globals() and v in BOMB_INDICES:
-                    return False
-                if 'SNAKE_INDEX' in globals() and SNAKE_INDEX is not None and v == SNAKE_INDEX:
-                    return False
-                return True
-            return False
-        if a == SPECIAL_BUBBLE3_INDEX and is_normal(b):
-            return True
-        if b == SPECIAL_BUBBLE3_INDEX and is_normal(a):
-            return True
-
-    tmp = grid[r1][c1]
-    grid[r1][c1] = grid[r2][c2]
-    grid[r2][c2] = tmp
-    ok = has_any_match(grid)
-    grid[r2][c2] = grid[r1][c1]
-    grid[r1][c1] = tmp
-    return ok
-
-def has_moves(grid):
-    for r in range(GRID_ROWS):
-        for c in range(GRID_COLS):
-            if c + 1 < GRID_COLS and would_match_after_swap(grid, r, c, r, c + 1):
-                return True
-            if r + 1 < GRID_ROWS and would_match_after_swap(grid, r, c, r + 1, c):
-                return True
-    return False
-
-def score_for_chain(length):
-    if length < 3:
-        return 0
-    if length >= 5:
-        return 20 + (length - 3) * 20 
-    return 15 + (length - 3) * 15
-
-
-def draw_board(surface, grid, images, font, selection=None, highlight_groups=None, chain_sizes=None):
-    pygame.draw.rect(surface, GRID_BG, (*BOARD_OFFSET, *BOARD_SIZE))
-    for i in range(GRID_COLS + 1):
-        x = BOARD_OFFSET[0] + i * CELL_SIZE
-        pygame.draw.line(surface, GRID_LINE, (x, BOARD_OFFSET[1]), (x, BOARD_OFFSET[1] + BOARD_SIZE[1]))
-    for j in range(GRID_ROWS + 1):
-        y = BOARD_OFFSET[1] + j * CELL_SIZE
-        pygame.draw.line(surface, GRID_LINE, (BOARD_OFFSET[0], y), (BOARD_OFFSET[0] + BOARD_SIZE[0], y))
-    
     if highlight_groups:
         for idx, group in enumerate(highlight_groups):
             chain_len = chain_sizes[idx] if chain_sizes else len(group)
@@ -598,45 +479,60 @@ def draw_board(surface, grid, images, font, selection=None, highlight_groups=Non
 
             for (r, c) in group:
                 x, y = grid_to_px(r, c)
-                rect = pygame.Rect(x + 2, y + 2, CELL_SIZE - 4, CELL_SIZE - 4)
-                pygame.draw.rect(surface, color, rect, border_radius=12)
+                inset = scaled(2)
+                rect = pygame.Rect(x + inset, y + inset, CELL_SIZE - 2 * inset, CELL_SIZE - 2 * inset)
+                pygame.draw.rect(surface, color, rect, border_radius=scaled(12))
 
         for idx, group in enumerate(highlight_groups):
-            rs = [r for (r, c) in group]
-            cs = [c for (r, c) in group]
-            minx, miny = grid_to_px(min(rs), min(cs))
-            maxx, maxy = grid_to_px(max(rs), max(cs))
-            center = (minx + (maxx - minx) + CELL_SIZE // 2, miny + (maxy - miny) + CELL_SIZE // 2)
-            label = font.render(f"x{chain_sizes[idx]}", True, (30, 30, 30))
-            rect = label.get_rect(center=center)
+            label = render_text(font, f"x{chain_sizes[idx]}", (30, 30, 30))
+            rect = label.get_rect(center=chain_label_center(group))
             surface.blit(label, rect)
 
-    for r in range(GRID_ROWS):
-        for c in range(GRID_COLS):
-            val = grid[r][c]
-            if val is None:
-                continue
-            img = images[val]
+    # one blits() call for the whole board, positions laid out row by row
+    cells = grid.cells
+    cols = grid.cols
+    xs = [left + c * CELL_SIZE for c in range(cols)]
+    surface.blits([(images[val], (xs[i % cols], top + i // cols * CELL_SIZE))
+                   for i, val in enumerate(cells) if val != EMPTY], False)
+
+    inset = scaled(3)
+    size = CELL_SIZE - 2 * inset
+    if hint is not None:
+        for r, c in hint:
             x, y = grid_to_px(r, c)
-            surface.blit(img, (x, y))
-
+            pygame.draw.rect(surface, HINT_COLOR, (x + inset, y + inset, size, size), scaled(3),
+                             border_radius=scaled(10))
     if selection is not None:
         r, c = selection
         x, y = grid_to_px(r, c)
-        pygame.draw.rect(surface, (255, 255, 255), (x + 3, y + 3, CELL_SIZE - 6, CELL_SIZE - 6), 3, border_radius=10)
-    draw_overlay(surface)
+        pygame.draw.rect(surface, (255, 255, 255), (x + inset, y + inset, size, size), scaled(3),
+                         border_radius=scaled(10))
+    surface.blits(over, False)
 
 def draw_header(surface, font, score, highscore,skin, difficulty=None):
     if skin ==1:
-        text = font.render(f"{score}", True, (200,200,255))
-        hs_text = font.render(f"{highscore}", True, (200,200,255))
+        text = render_text(font, f"{score}", (200,200,255))
+        hs_text = render_text(font, f"{highscore}", (200,200,255))
     else:
-        text = font.render(f"{score}", True, SCORE_COLOR)
-        hs_text = font.render(f"{highscore}", True, SCORE_COLOR)
+        text = render_text(font, f"{score}", SCORE_COLOR)
+        hs_text = render_text(font, f"{highscore}", SCORE_COLOR)
 
     surface.blit(text, (BOARD_OFFSET[0]+40, BOARD_OFFSET[1] - 78))
     surface.blit(hs_text, (WINDOW_SIZE[0] - BOARD_OFFSET[0] - hs_text.get_width()-42, BOARD_OFFSET[1] - 78))
 
+def header_rect(font):
+    # the strip the score and high score are drawn in
+    return pygame.Rect(BOARD_OFFSET[0], BOARD_OFFSET[1] - 78, WINDOW_SIZE[0] - 2 * BOARD_OFFSET[0], font.get_linesize())
+
+HURRY_CENTERS = ((100, WINDOW_SIZE[1] - 20), (900, WINDOW_SIZE[1] - 20))
+
+def hurry_rect(font):
+    # the strip both HURRY! labels flash in
+    rects = [pygame.Rect((0, 0), font.size("HURRY!")) for _ in HURRY_CENTERS]
+    for rect, center in zip(rects, HURRY_CENTERS):
+        rect.center = center
+    return rects[0].union(rects[1])
+
 def draw_hurry(surface, font):
         global hurry_flash_timer, timer_sound
         if hurry_flash_timer == 0:
@@ -647,10 +543,10 @@ def draw_hurry(surface, font):
                 except Exception as e:
                     print("Error playing timer sound:", e)
         if hurry_flash_timer <= 10:
-            text = font.render("HURRY!", True, (255, 80, 80))
-            rect = text.get_rect(center=(100, WINDOW_SIZE[1] - 20))
+            text = render_text(font, "HURRY!", (255, 80, 80))
+            rect = text.get_rect(center=HURRY_CENTERS[0])
             surface.blit(text, rect)
-            rect1 = text.get_rect(center=(900, WINDOW_SIZE[1] - 20))
+            rect1 = text.get_rect(center=HURRY_CENTERS[1])
             surface.blit(text, rect1)
             hurry_flash_timer -= 1
             
@@ -658,15 +554,18 @@ def draw_hurry(surface, font):
             hurry_flash_timer -= 1
         
 def draw_game_over(surface, custom_font, custom_font1, score, highscore, title_type):
-    
-    overlay = pygame.Surface(WINDOW_SIZE, pygame.SRCALPHA)
-    overlay.fill((0, 0, 0, 170))
+    overlay = LAYER_CACHE.get(("game over", surface.get_size()))
+    if overlay is None:
+        overlay = LAYER_CACHE[("game over", surface.get_size())] = pygame.Surface(surface.get_size(), pygame.SRCALPHA)
+        overlay.fill((0, 0, 0, 170))
     surface.blit(overlay, (0, 0))
-    if title_type == 2: title = custom_font.render("No more moves", True, GAMEOVER_COLOR) 
+    if title_type == 2: title = render_text(custom_font, "No more moves", GAMEOVER_COLOR) 
+    elif title_type == 3: title = render_text(custom_font, "Puzzle Solved", GAMEOVER_COLOR)
+    elif title_type == 4: title = render_text(custom_font, "Out of Moves", GAMEOVER_COLOR)
     else:
-        title = custom_font.render("Time Is Up", True, GAMEOVER_COLOR)
-    sub = custom_font1.render("Press R to restart or ESC to quit", True, (230, 230, 240))
-    score_t = custom_font1.render(f"Final Score: {score}  |  High Score: {highscore}", True, (230, 230, 240))
+        title = render_text(custom_font, "Time Is Up", GAMEOVER_COLOR)
+    sub = render_text(custom_font1, "Press R to restart or ESC to quit", (230, 230, 240))
+    score_t = render_text(custom_font1, f"Final Score: {score}  |  High Score: {highscore}", (230, 230, 240))
     rect = title.get_rect(center=(WINDOW_SIZE[0]//2, WINDOW_SIZE[1]//2 - 40))
     rect2 = sub.get_rect(center=(WINDOW_SIZE[0]//2, WINDOW_SIZE[1]//2 + 40))
     rect3 = score_t.get_rect(center=(WINDOW_SIZE[0]//2, WINDOW_SIZE[1]//2 + 5))
@@ -675,52 +574,89 @@ def draw_game_over(surface, custom_font, custom_font1, score, highscore, title_t
     surface.blit(sub, rect2)
 
 
+class FrameDiff:
+    # what the frame on screen shows, so the next one redraws only what has
+    # changed. plan() takes the next frame's HUD key (everything drawn off the
+    # board without a rect of its own), the (key, rect) of the HUD parts that
+    # have one (timer bar, header, hurry banner), the board cells and the
+    # marks on them (selection, hint, highlights). It returns None when
+    # nothing changed, the whole screen when the HUD key did, or else the
+    # rect around the parts, cells and labels that did
+    def __init__(self):
+        self.hud = None
+        self.parts = ()
+        self.cells = None
+        self.marks = None
+
+    def reset(self):
+        # the window was made again or uncovered; redraw all of it next
+        self.hud = None
+
+    def plan(self, screen, hud, cells=None, marks=None, font=None, parts=()):
+        old_hud, old_parts, old_cells, old_marks = self.hud, self.parts, self.cells, self.marks
+        self.hud, self.cells, self.marks = hud, cells, marks
+        self.parts = tuple(key for key, _ in parts)
+        if hud != old_hud or (cells is None) != (old_cells is None) or len(parts) != len(old_parts):
+            return screen.get_rect()
+        rects = [rect for (key, rect), old in zip(parts, old_parts) if key != old]
+        if cells is not None and cells != old_cells:
+            rects += [pygame.Rect(grid_to_px(*divmod(i, GRID_COLS)), (CELL_SIZE, CELL_SIZE))
+                      for i, (a, b) in enumerate(zip(cells, old_cells)) if a != b]
+        if marks != old_marks:
+            for mark in (old_marks, marks):
+                rects += mark_rects(*mark, font)
+        return rects[0].unionall(rects[1:]) if rects else None
+
+def mark_rects(selection, hint, highlight_groups, chain_sizes, font):
+    # the screen rects draw_board's marks cover
+    cells = list(hint or ())
+    if selection is not None:
+        cells.append(selection)
+    for group in highlight_groups or ():
+        cells += group
+    rects = [pygame.Rect(grid_to_px(r, c), (CELL_SIZE, CELL_SIZE)) for r, c in cells]
+    for idx, group in enumerate(highlight_groups or ()):
+        rect = pygame.Rect((0, 0), font.size(f"x{chain_sizes[idx]}"))
+        rect.center = chain_label_center(group)
+        rects.append(rect)
+    return rects
+
+def present(window, screen, rect=None):
+    # the logical screen scaled and centred in the window. With a rect at
+    # 1:1 scale only that part is copied and pushed to the display; a scaled
+    # window is smoothed as a whole, since a part scaled on its own comes out
+    # a pixel off at its edges
+    win_w, win_h = window.get_size()
+    base_w, base_h = WINDOW_SIZE
+    scale = min(win_w / base_w, win_h / base_h) if win_w and win_h else 1.0
+    render_w = int(base_w * scale)
+    render_h = int(base_h * scale)
+    off_x = (win_w - render_w) // 2
+    off_y = (win_h - render_h) // 2
+
+    if rect is not None and render_w == base_w and render_h == base_h:
+        pygame.display.update(window.blit(screen, (off_x + rect.x, off_y + rect.y), rect))
+        return
+    window.fill((0, 0, 0))
+    if render_w != base_w or render_h != base_h:
+        window.blit(pygame.transform.smoothscale(screen, (render_w, render_h)), (off_x, off_y))
+    else:
+        window.blit(screen, (off_x, off_y))
+    pygame.display.flip()
+
+
 def pos_to_cell(mx, my):
-    if not (BOARD_OFFSET[0] <= mx < BOARD_OFFSET[0] + BOARD_SIZE[0] and BOARD_OFFSET[1] <= my < BOARD_OFFSET[1] + BOARD_SIZE[1]):
+    c = (mx - GRID_ORIGIN[0]) // CELL_SIZE
+    r = (my - GRID_ORIGIN[1]) // CELL_SIZE
+    if not (0 <= r < GRID_ROWS and 0 <= c < GRID_COLS):
         return None
-    c = (mx - BOARD_OFFSET[0]) // CELL_SIZE
-    r = (my - BOARD_OFFSET[1]) // CELL_SIZE
     return int(r), int(c)
 
-def are_adjacent(a, b):
-    (r1, c1), (r2, c2) = a, b
-    return (abs(r1 - r2) == 1 and c1 == c2) or (abs(c1 - c2) == 1 and r1 == r2)
-
-def draw_overlay(screen):
-    global skin, OVERLAY_CACHE
-    overlay_img = OVERLAY_CACHE.get("board", {}).get(skin)
-    if overlay_img:
-        screen.blit(overlay_img, (0, 0))
-        return
-    overlay_path = OVERLAY_PATHS["board"][1 if skin == 1 else 2]
-    overlay_img = load_scaled_overlay(overlay_path, screen.get_size())
-    OVERLAY_CACHE.setdefault("board", {})[skin] = overlay_img
-    if overlay_img:
-        screen.blit(overlay_img, (0, 0))
-
 def draw_overlaytop(screen):
-    global skin, OVERLAY_CACHE
-    overlay_img = OVERLAY_CACHE.get("top", {}).get(skin)
-    if overlay_img:
-        screen.blit(overlay_img, (0, 0))
-        return
-    overlay_path = OVERLAY_PATHS["top"][1 if skin == 1 else 2]
-    overlay_img = load_scaled_overlay(overlay_path, screen.get_size())
-    OVERLAY_CACHE.setdefault("top", {})[skin] = overlay_img
-    if overlay_img:
-        screen.blit(overlay_img, (0, 0))
+    screen.blits(overlay_layer("top", skin, screen.get_size()), False)
 
 def draw_overlaytmenu(screen):
-    global skin, OVERLAY_CACHE
-    overlay_img = OVERLAY_CACHE.get("menu", {}).get(skin)
-    if overlay_img:
-        screen.blit(overlay_img, (0, 0))
-        return
-    overlay_path = OVERLAY_PATHS["menu"][1 if skin == 1 else 2]
-    overlay_img = load_scaled_overlay(overlay_path, screen.get_size())
-    OVERLAY_CACHE.setdefault("menu", {})[skin] = overlay_img
-    if overlay_img:
-        screen.blit(overlay_img, (0, 0))
+    screen.blit(menu_layer(screen), (0, 0))
 
 def draw_volume_control(surface, volume, font):
     global mute
@@ -750,8 +686,8 @@ def draw_volume_control(surface, volume, font):
     pygame.draw.rect(surface, (200, 200, 240), up_rect, border_radius=18)
     pygame.draw.rect(surface, (200, 200, 240), down_rect, border_radius=18)
 
-    up_label = font.render("+", True, (30, 30, 30))
-    down_label = font.render("-", True, (30, 30, 30))
+    up_label = render_text(font, "+", (30, 30, 30))
+    down_label = render_text(font, "-", (30, 30, 30))
     surface.blit(up_label, up_label.get_rect(center=up_rect.center))
     surface.blit(down_label, down_label.get_rect(center=down_rect.center))
     return up_rect, down_rect
@@ -781,57 +717,12 @@ def draw_volume_control1(surface, m_volume, font):
     down_rect1 = pygame.Rect(bar_x - 9, bar_y + bar_height + 9, bar_width + 19, 39)
     pygame.draw.rect(surface, (200, 200, 240), up_rect1, border_radius=18)
     pygame.draw.rect(surface, (200, 200, 240), down_rect1, border_radius=18)
-    up_label = font.render("+", True, (30, 30, 30))
-    down_label = font.render("-", True, (30, 30, 30))
+    up_label = render_text(font, "+", (30, 30, 30))
+    down_label = render_text(font, "-", (30, 30, 30))
     surface.blit(up_label, up_label.get_rect(center=up_rect1.center))
     surface.blit(down_label, down_label.get_rect(center=down_rect1.center))
     return up_rect1, down_rect1
 
-def get_bomb_effect_cells(bomb_type, r, c):
-    cells = set()
-    if bomb_type == 0:
-        for cc in range(GRID_COLS):
-            cells.add((r, cc))
-    elif bomb_type == 1:
-        for rr in range(GRID_ROWS):
-            cells.add((rr, c))
-    else:
-        for cc in range(GRID_COLS):
-            cells.add((r, cc))
-        for rr in range(GRID_ROWS):
-            cells.add((rr, c))
-    return cells
-
-def insert_random_bomb_top(grid, bomb_indices):
-    if not bomb_indices:
-        return
-    c = random.randrange(0, GRID_COLS)
-    bomb_idx = random.choice(bomb_indices)
-    for r in range(GRID_ROWS - 1, 0, -1):
-        grid[r][c] = grid[r-1][c]
-    grid[0][c] = bomb_idx
-
-def generate_snake_path(start_r, start_c, steps=10):
-    path = [(start_r, start_c)]
-    for _ in range(steps - 1):
-        r, c = path[-1]
-        nbrs = []
-        if r > 0: nbrs.append((r - 1, c))
-        if r < GRID_ROWS - 1: nbrs.append((r + 1, c))
-        if c > 0: nbrs.append((r, c - 1))
-        if c < GRID_COLS - 1: nbrs.append((r, c + 1))
-        random.shuffle(nbrs)
-        if len(path) >= 2:
-            prev = path[-2]
-            if prev in nbrs:
-                nbrs.remove(prev)
-                nbrs.append(prev)
-        if nbrs:
-            path.append(nbrs[0])
-        else:
-            break
-    return path
-
 ##################################################################
 #     #####     ###   #######   ###   ### ###   ####        ######
 #   #########   ###    #####    ###   ##   ##   ###   ####   #####
@@ -842,8 +733,136 @@ def generate_snake_path(start_r, start_c, steps=10):
 #      ###      ###   ### ###   ###   #######   ####        ######
 ##################################################################
 
-async def main():
-    global BOMB_INDICES, mute, hurry_flash_timer, skin, timer_sound, SNAKE_INDEX
+class Autoplay:
+    # soak testing: a policy plays game after game through main()'s own event
+    # handling by posting the clicks and keys a player would. Highlights take
+    # no time, frames are uncapped and the board is drawn every render_every
+    # frames (0 for never)
+    def __init__(self, policy="random", render_every=0, difficulties=None, games=0, minutes=0,
+                 log_path=None, seed=None):
+        from balance import MAX_SWAPS, load_policy
+        self.policy = load_policy(policy)
+        self.render_every = render_every
+        self.difficulties = difficulties or CLASSIC_MODES
+        self.max_swaps = MAX_SWAPS
+        self.games_wanted = games
+        self.deadline = time.time() + minutes * 60 if minutes else None
+        self.log_file = open(log_path, "a", encoding="utf-8") if log_path else sys.stdout
+        self.rng = random.Random(seed)
+        self.game = None
+        self.games = 0
+        self.moves = 0
+        self.crashes = 0
+        self.frame = 0
+        self.started = time.time()
+        self.reported = self.started
+
+    def log(self, text):
+        print(f"[{time.strftime('%H:%M:%S')}] {text}", file=self.log_file, flush=True)
+
+    def finished(self):
+        if self.games_wanted and self.games + self.crashes >= self.games_wanted:
+            return True
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def should_render(self):
+        return self.render_every > 0 and self.frame % self.render_every == 0
+
+    def click(self, window, pos):
+        # logical board position to window pixels, the inverse of to_logical
+        wx, wy = window.get_size()
+        bw, bh = WINDOW_SIZE
+        scale = min(wx / bw, wy / bh) if wx and wy else 1.0
+        x = (wx - int(bw * scale)) // 2 + int(pos[0] * scale)
+        y = (wy - int(bh * scale)) // 2 + int(pos[1] * scale)
+        pygame.event.post(pygame.event.Event(MOUSEBUTTONDOWN, pos=(x, y), button=1))
+
+    def press(self, key):
+        pygame.event.post(pygame.event.Event(KEYDOWN, key=key, mod=0, unicode="", scancode=0))
+
+    def drive(self, window, state, game, busy):
+        # posts this frame's input; called before main() reads its events
+        self.frame += 1
+        self.game = game
+        if self.finished():
+            pygame.event.post(pygame.event.Event(QUIT))
+        elif state == MENU:
+            label = self.difficulties[self.games % len(self.difficulties)]
+            rect = next(rect for rect, text in menu_buttons() if text == label)
+            self.click(window, rect.center)
+        elif state == GAME_OVER or (state == PLAYING and not busy and game.swaps >= self.max_swaps):
+            # untimed games on a big board may never lock, so they stop where
+            # balance.py stops them
+            self.games += 1
+            self.moves += game.swaps
+            self.log(f"game {self.games}: {game.difficulty} seed {game.seed} score {game.score}"
+                     f" swaps {game.swaps} ended by {game.end or 'the swap limit'}")
+            self.press(K_r)
+        elif not busy and not game.is_over():
+            (r1, c1), (r2, c2) = self.policy(game, self.rng)
+            x, y = grid_to_px(r1, c1)
+            self.click(window, (x + CELL_SIZE // 2, y + CELL_SIZE // 2))
+            x, y = grid_to_px(r2, c2)
+            self.click(window, (x + CELL_SIZE // 2, y + CELL_SIZE // 2))
+        now = time.time()
+        if now - self.reported >= 60:
+            self.report()
+            self.reported = now
+
+    def report(self):
+        minutes = (time.time() - self.started) / 60
+        self.log(f"{self.games} games, {self.moves} moves, {self.crashes} crashes in {minutes:.1f} min:"
+                 f" {self.games / minutes:.1f} games/min, {self.moves / minutes:.0f} moves/min")
+
+    def crash(self):
+        # the traceback, the seed and the game so far as a replay to rerun it
+        self.crashes += 1
+        game = self.game
+        self.log(f"crash {self.crashes}: {game.difficulty if game else None} seed {game.seed if game else None}"
+                 f" after {game.swaps if game else 0} swaps\n{traceback.format_exc()}")
+        if game is not None and game.log:
+            try:
+                path = f"crash-{game.seed}.replay"
+                replay.save(path, replay.Replay.from_game(game))
+                self.log(f"replay saved to {path}")
+            except Exception as e:
+                self.log(f"could not save the replay: {e}")
+
+async def soak(autoplay):
+    global KEEP_RECORDS, HIGHLIGHT_DELAY_MS, SNAKE_STEP_DELAY_MS
+    KEEP_RECORDS = False
+    HIGHLIGHT_DELAY_MS = 0
+    SNAKE_STEP_DELAY_MS = 0
+    # a crash ends main(), so start it again until the run is over
+    while not autoplay.finished():
+        try:
+            await main(autoplay)
+        except Exception:
+            autoplay.crash()
+    autoplay.report()
+
+def parse_autoplay(argv):
+    parser = argparse.ArgumentParser(description="Bot-Swapper; --autoplay soaks the game with a bot.")
+    parser.add_argument("--autoplay", action="store_true", help="let a policy play game after game")
+    parser.add_argument("--policy", default="random", help="random, first, greedy, lookahead or module:function")
+    parser.add_argument("--render", type=int, default=0, metavar="N", help="draw every Nth frame, 0 for never")
+    parser.add_argument("--difficulty", action="append", choices=list(DIFFICULTY_SETTINGS),
+                        help="difficulty to play, repeatable (default: the classic board ones in turn)")
+    parser.add_argument("--games", type=int, default=0, help="stop after this many games")
+    parser.add_argument("--minutes", type=float, default=0, help="stop after this long")
+    parser.add_argument("--seed", type=int, help="seed the bot and the game seeds")
+    parser.add_argument("--log", help="append the log here instead of printing it")
+    args = parser.parse_args(argv)
+    if not args.autoplay:
+        return None
+    if args.seed is not None:
+        random.seed(args.seed)
+    if not args.render:
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    return Autoplay(args.policy, args.render, args.difficulty, args.games, args.minutes, args.log, args.seed)
+
+async def main(autoplay=None):
+    global mute, hurry_flash_timer, skin, timer_sound
     pygame.init()
     has_audio = False
     if not IS_WEB:
@@ -946,33 +965,69 @@ async def main():
     custom_font1 = load_font_safe(font_path, font_size1, "custom_font1")
     custom_font2 = load_font_safe(font_path, font_size2, "custom_font2")
     
-    images, BOMB_INDICES = load_all_images()
-    grid = create_grid(no_start_matches=True)
+    set_board_size(GRID_ROWS, GRID_COLS)
+    images = tile_images()
+    # S on the menu: deal the board out again instead of "No more moves"
+    reshuffle = False
+
+    # the next board is built on idle frames, so starting a game is instant
+    prefetch = BoardPrefetcher()
+    # what is on screen, so frames where nothing changed aren't drawn
+    frame = FrameDiff()
+    game = None
+    # the engine plays moves out on game.grid while view shows them replayed
+    view = None
     score = 0
+    # P plays puzzles in file order, moving on once one is solved
+    puzzles = None
+    puzzle_index = 0
+    events_left = []
     highscores = load_highscores()
     highscore = 0
 
     selection = None
+    # H starts a hint search; it gets a slice of every frame until done
+    hint_search = None
+    # (swap_steps generator, clicked cell) while a swap's cascade is still
+    # being resolved, a slice a frame; the game clock waits for it
+    pending_swap = None
     showing_highlights_until = 0
     highlight_groups = None
     chain_sizes = None
     game_over = False
     title_type = 1
     game_state = MENU
-    buttons = []
+    buttons = menu_buttons()
     current_difficulty = None
     timer_duration = None
-    timer_start = None
     timer_color = (80,255,80)
     timer_switch = False
 
     if has_audio:
         initialize_audio()
 
-    bombs_unlocked = False
-    snake_unlocked = False
-    next_bomb_time = 0
-    highlight_from_bomb = False
+    def start_game(new_game, label):
+        nonlocal game, view, current_difficulty, highscore, timer_duration, score, events_left, snake_queue
+        nonlocal selection, hint_search, pending_swap, showing_highlights_until, highlight_groups, chain_sizes
+        nonlocal game_over, game_state, images
+        game = new_game
+        set_board_size(game.grid.rows, game.grid.cols)
+        images = tile_images()
+        view = game.grid.copy()
+        current_difficulty = label
+        highscore = highscores.get(label, 0)
+        timer_duration = game.duration
+        score = 0
+        events_left = []
+        snake_queue = []
+        selection = None
+        hint_search = None
+        pending_swap = None
+        showing_highlights_until = 0
+        highlight_groups = None
+        chain_sizes = None
+        game_over = False
+        game_state = PLAYING
 
     def to_logical(pos, win_size):
         wx, wy = win_size
@@ -991,7 +1046,6 @@ async def main():
         ly = int((y - off_y) / scale)
         return (lx, ly)
 
-    snake_mode = False
     snake_queue = []
     score_messages = []
 
@@ -1004,7 +1058,11 @@ async def main():
             pass
     running = True
     while running:
-        dt = clock.tick(FPS)
+        dt = clock.tick(0 if autoplay else FPS)
+        if autoplay:
+            # uncapped, but the game clock still runs at the normal frame rate
+            dt = 1000 // FPS
+            autoplay.drive(window, game_state, game, events_left or snake_queue or pending_swap)
 
         if has_audio:
             if not mute:
@@ -1037,21 +1095,50 @@ async def main():
                     else:
                         window = pygame.display.set_mode(windowed_size, window_flags)
                         is_fullscreen = False
+                    frame.reset()
                 
+                if event.key == K_h and game_state == PLAYING and not game_over and pending_swap is None:
+                    hint_search = HintSearch.for_game(game)
+                if event.key in (K_u, K_y) and game_state != MENU and game.history is not None \
+                        and pending_swap is None:
+                    if game.undo() if event.key == K_u else game.redo():
+                        # the board jumps straight there, out of "no more
+                        # moves" too; whatever the last move had left to
+                        # show is dropped
+                        game_over = game.over
+                        game_state = GAME_OVER if game_over else PLAYING
+                        view = game.grid.copy()
+                        score = game.score
+                        selection = None
+                        hint_search = None
+                        events_left = []
+                        snake_queue = []
+                        highlight_groups = None
+                        chain_sizes = None
+                if event.key == K_s and game_state == MENU:
+                    reshuffle = not reshuffle
+                if event.key == K_p and game_state != PLAYING:
+                    if puzzles is None:
+                        puzzles = puzzle.load_all()
+                    if puzzles:
+                        start_game(puzzle.PuzzleGame(puzzles[puzzle_index % len(puzzles)]), "Puzzle")
                 if event.key == K_r:
+                    if game_state == PLAYING and not isinstance(game, puzzle.PuzzleGame):
+                        save_replay(game)
                     game_state = MENU
-                    game_over = False
-                    selection = None
-                    highlight_groups = None
-                    chain_sizes = None
-                    showing_highlights_until = 0
-                    score = 0
-                    grid = create_grid(no_start_matches=True)
-                    bombs_unlocked = False
+                    # whatever the last move had left to show is dropped
+                    hint_search = None
+                    pending_swap = None
+                    events_left = []
+                    snake_queue = []
             
             elif event.type == VIDEORESIZE and not is_fullscreen:
                 windowed_size = (event.w, event.h)
                 window = pygame.display.set_mode(windowed_size, window_flags)
+                frame.reset()
+
+            elif event.type in (VIDEOEXPOSE, WINDOWEXPOSED):
+                frame.reset()
 
             elif event.type == MOUSEBUTTONDOWN and event.button == 1:
                 if not audio_assets_loaded:
@@ -1060,21 +1147,8 @@ async def main():
                 if game_state == MENU:
                     for rect, label in buttons:
                         if rect.collidepoint(logical_pos):
-                            current_difficulty = label
-                            timer_duration = DIFFICULTY_SETTINGS[label]
-                            timer_start = pygame.time.get_ticks()
-                            highscore = highscores.get(current_difficulty, 0)
-                            current_difficulty = label
-                            timer_duration = DIFFICULTY_SETTINGS[label]
-                            timer_start = pygame.time.get_ticks()
-                            grid = create_grid(no_start_matches=True)
-                            score = 0
-                            selection = None
-                            showing_highlights_until = 0
-                            highlight_groups = None
-                            chain_sizes = None
-                            game_over = False
-                            game_state = PLAYING
+                            start_game(prefetch.start(label, reshuffle=reshuffle, practice=label == "Free Play"),
+                                       label)
                             if has_audio:
                                 try:
                                     pygame.mixer.music.play(-1)
@@ -1102,6 +1176,9 @@ async def main():
                                 mute = False
                             elif down_rect1.collidepoint(logical_pos):
                                 m_volume = max(0.0, m_volume - 0.1)
+                    if events_left or snake_queue or pending_swap:
+                        # the last move is still playing out
+                        continue
                     cell = pos_to_cell(*logical_pos)
                     if cell is None:
                         selection = None
@@ -1113,322 +1190,150 @@ async def main():
                                 selection = None
                             elif are_adjacent(selection, cell):
                                 (r1, c1), (r2, c2) = selection, cell
-                                if not in_bounds(r1, c1) or not in_bounds(r2, c2):
+                                if not game.grid.in_bounds(r1, c1) or not game.grid.in_bounds(r2, c2):
                                     selection = None
                                     continue
 
-                                a = grid[r1][c1]
-                                b = grid[r2][c2]
-                                a_is_bomb = a in BOMB_INDICES
-                                b_is_bomb = b in BOMB_INDICES
-
-                                if ((a == SPECIAL_BUBBLE_INDEX or b == SPECIAL_BUBBLE_INDEX) and not (a_is_bomb or b_is_bomb)):
-                                    selection = None
-                                else:
-                                    grid[r1][c1], grid[r2][c2] = b, a
-                                    a_is_b9 = ('SPECIAL_BUBBLE3_INDEX' in globals()) and (a == SPECIAL_BUBBLE3_INDEX)
-                                    b_is_b9 = ('SPECIAL_BUBBLE3_INDEX' in globals()) and (b == SPECIAL_BUBBLE3_INDEX)
-                                    if a_is_b9 or b_is_b9:
-                                        total = len(BUBBLE_NAMES)
-                                        def is_normal(v):
-                                            if v is None:
-                                                return False
-                                            if isinstance(v, int) and 0 <= v < total:
-                                                if v == SPECIAL_BUBBLE_INDEX:
-                                                    return False
-                                                if 'SPECIAL_BUBBLE2_INDEX' in globals() and v == SPECIAL_BUBBLE2_INDEX:
-                                                    return False
-                                                if 'SPECIAL_BUBBLE3_INDEX' in globals() and v == SPECIAL_BUBBLE3_INDEX:
-                                                    return False
-                                                if 'BOMB_INDICES' in globals() and v in BOMB_INDICES:
-                                                    return False
-                                                if 'SNAKE_INDEX' in globals() and SNAKE_INDEX is not None and v == SNAKE_INDEX:
-                                                    return False
-                                                return True
-                                            return False
-
-                                        dest_r_b9, dest_c_b9 = None, None
-                                        if a_is_b9 and is_normal(b):
-                                            target = b
-                                            dest_r_b9, dest_c_b9 = r2, c2
-                                        elif b_is_b9 and is_normal(a):
-                                            target = a
-                                            dest_r_b9, dest_c_b9 = r1, c1
-                                        else:
-                                            target = None
-                                        if target is not None:
-                                            affected = set()
-                                            for rr in range(GRID_ROWS):
-                                                for cc in range(GRID_COLS):
-                                                    if grid[rr][cc] == target:
-                                                        affected.add((rr, cc))
-                                            if dest_r_b9 is not None:
-                                                affected.add((dest_r_b9, dest_c_b9))
-                                            if affected:
-                                                highlight_groups = [affected]
-                                                chain_sizes = [len(affected)]
-                                                highlight_from_bomb = True
-                                                added_points = score_for_chain(len(affected))
-                                                score += added_points
-                                                add_score_message(added_points)
-                                                showing_highlights_until = pygame.time.get_ticks() + HIGHLIGHT_DELAY_MS
-                                                selection = None
-                                                continue
-
-                                    if a_is_bomb or b_is_bomb:
-                                        if a_is_bomb and not b_is_bomb:
-                                            dest_r, dest_c = r2, c2
-                                            power_idx = a
-                                        elif b_is_bomb and not a_is_bomb:
-                                            dest_r, dest_c = r1, c1
-                                            power_idx = b
-                                        else:
-                                            dest_r, dest_c = r2, c2
-                                            power_idx = b
-
-                                        if SNAKE_INDEX is not None and power_idx == SNAKE_INDEX:
-                                            if snake_sound:
-                                                if not mute:
-                                                    snake_sound.set_volume(volume)
-                                                else:
-                                                    snake_sound.set_volume(0.0)
-                                                snake_sound.play()
-                                            snake_queue = generate_snake_path(dest_r, dest_c, steps=10)
-                                            if snake_queue:
-                                                snake_mode = True
-                                                highlight_groups = [set([snake_queue[0]])]
-                                                chain_sizes = [1]
-                                                highlight_from_bomb = True
-                                                showing_highlights_until = pygame.time.get_ticks() + SNAKE_STEP_DELAY_MS
-                                            selection = None
-                                        else:
-                                            if power_idx in BOMB_INDICES[:3]:
-                                                bomb_type = BOMB_INDICES[:3].index(power_idx)
-                                            else:
-                                                bomb_type = random.randrange(0, 3)
-                                            
-                                            if bomb_sound:
-                                                if not mute:
-                                                    bomb_sound.set_volume(volume)
-                                                else:
-                                                    bomb_sound.set_volume(0.0)
-                                                bomb_sound.play()
-                                            affected = get_bomb_effect_cells(bomb_type, dest_r, dest_c)
-                                            highlight_groups = [affected]
-                                            chain_sizes = [len(affected)]
-                                            highlight_from_bomb = True
-                                            added_points = score_for_chain(len(affected))
-                                            score += added_points
-                                            add_score_message(added_points)
-                                            next_bomb_time += 1
-                                            if timer_duration:
-                                                timer_start = add_time(1, timer_duration, timer_start)
-                                            if pop_sounds:
-                                                s = random.choice(pop_sounds)
-                                                if not mute:
-                                                    s.set_volume(volume)
-                                                else:
-                                                    s.set_volume(0.0)
-                                                    volume = 0.0
-                                                    m_volume = 0.0
-                                                s.play()
-                                            showing_highlights_until = pygame.time.get_ticks() + HIGHLIGHT_DELAY_MS
-                                            selection = None
-
-                                    else:
-                                        matches = find_all_matches_wild_any(grid)
-                                        if matches:
-                                            selection = None
-                                            highlight_groups = matches
-                                            chain_sizes = [len(g) for g in matches]
-                                            highlight_from_bomb = False
-                                            added_points = sum(score_for_chain(len(g)) for g in matches)
-                                            score += added_points
-                                            add_score_message(added_points)
-
-                                            if  any(size >= 5 for size in chain_sizes):
-                                                if fiver_sound:
-                                                    try:
-                                                        if not mute:
-                                                            fiver_sound.set_volume(volume)
-                                                        else:
-                                                            fiver_sound.set_volume(0.0)
-                                                        fiver_sound.play()
-                                                    except Exception as e:
-                                                        print("Error playing fiver sound:", e)
-
-                                            next_bomb_time +=1
-                                            if timer_duration:
-                                                timer_start = add_time(1, timer_duration, timer_start)
-                                            if pop_sounds:
-                                                s = random.choice(pop_sounds)
-                                                s.set_volume(volume)
-                                                s.play()
-                                            showing_highlights_until = pygame.time.get_ticks() + HIGHLIGHT_DELAY_MS
-                                        else:
-                                            grid[r1][c1], grid[r2][c2] = a, b
-                                            selection = cell
+                                pending_swap = (game.swap_steps(r1, c1, r2, c2, record=True), cell)
                             else:
                                 selection = cell
 
-        now = pygame.time.get_ticks()
-        if not bombs_unlocked and score >= 1500:
-            bombs_unlocked = True
-            next_bomb_time = 0
-
-        if bombs_unlocked and next_bomb_time >= 40:
-            insert_random_bomb_top(grid, BOMB_INDICES)
-            next_bomb_time = 0
-
-        if not snake_unlocked and score >= 3000:
-            snake_unlocked = True
-            if SNAKE_INDEX is not None and SNAKE_INDEX not in BOMB_INDICES:
-                BOMB_INDICES.append(SNAKE_INDEX)
+        # a big board's cascade can take longer than a frame to resolve, so
+        # it runs a slice a frame and is shown once the board has settled
+        if pending_swap is not None:
+            done, result = run_slice(pending_swap[0], RESOLVE_BUDGET_MS)
+            if done:
+                cell = pending_swap[1]
+                pending_swap = None
+                if not result["accepted"]:
+                    selection = None if result["blocked"] else cell
+                else:
+                    selection = None
+                    hint_search = None
+                    events_left = result["events"]
 
-        if highlight_groups and now >= showing_highlights_until and not game_over:
-            if snake_mode:
-                if snake_queue:
-                    r, c = snake_queue.pop(0)
-                    if in_bounds(r, c):
-                        grid[r][c] = None
+        # the engine has already settled the board; step through its events
+        # so the player sees each clear, fall and cascade in turn
+        now = pygame.time.get_ticks()
+        while (events_left or snake_queue) and now >= showing_highlights_until and not game_over:
+            highlight_groups = None
+            chain_sizes = None
+            if snake_queue:
+                r, c = snake_queue.pop(0)
+                view.set(r, c, EMPTY)
                 if snake_queue:
                     highlight_groups = [set([snake_queue[0]])]
                     chain_sizes = [1]
-                    highlight_from_bomb = True
-                    showing_highlights_until = pygame.time.get_ticks() + SNAKE_STEP_DELAY_MS
-                else:
-                    highlight_groups = None
-                    chain_sizes = None
-                    highlight_from_bomb = False
-                    snake_mode = False
-                    apply_gravity_and_refill(grid, score)
-                    cascade_matches = find_all_matches_wild_any(grid)
-                    if cascade_matches:
-                        highlight_groups = cascade_matches
-                        chain_sizes = [len(g) for g in cascade_matches]
-                        highlight_from_bomb = False
-                        added_points = sum(score_for_chain(len(g)) for g in cascade_matches)
-                        score += added_points
-                        add_score_message(added_points)
-                        if any(size >= 5 for size in chain_sizes):
-                            if fiver_sound:
-                                try:
-                                    if not mute:
-                                        fiver_sound.set_volume(volume)
-                                    else:
-                                        fiver_sound.set_volume(0.0)
-                                    fiver_sound.play()
-                                except Exception as e:
-                                    print("Error playing fiver sound:", e)
-                        next_bomb_time += 1
-                        if timer_duration:
-                            timer_start = add_time(1, timer_duration, timer_start)
-                        if pop_sounds:
-                            s = random.choice(pop_sounds)
-                            if not mute:
-                                s.set_volume(volume)
-                                if has_audio:
-                                    try:
-                                        pygame.mixer.music.set_volume(m_volume)
-                                    except Exception as e:
-                                        print("Error setting music volume:", e)
-                            else:
-                                s.set_volume(0.0)
-                                volume = 0.0
-                                m_volume = 0.0
-                            s.play()
-                        showing_highlights_until = pygame.time.get_ticks() + HIGHLIGHT_DELAY_MS
-                    else:
-                        if not has_moves(grid):
-                            title_type = 2
-                            game_over = True
-                            game_state = GAME_OVER
-                            save_highscore(current_difficulty, score)
-                            highscores = load_highscores()
-                            highscore = highscores.get(current_difficulty, 0)
-            else:
-                for group in highlight_groups:
-                    for (r, c) in group:
-                        if highlight_from_bomb:
-                            grid[r][c] = None
+                    showing_highlights_until = now + SNAKE_STEP_DELAY_MS
+                    break
+                continue
+
+            event = events_left.pop(0)
+            kind = event[0]
+            if kind == "swap":
+                view.swap(*event[1], *event[2])
+            elif kind == "clear":
+                _, cause, groups, sizes, points, path = event
+                if cause == "snake":
+                    if snake_sound:
+                        if not mute:
+                            snake_sound.set_volume(volume)
                         else:
-                            if grid[r][c] != SPECIAL_BUBBLE_INDEX:
-                                grid[r][c] = None
+                            snake_sound.set_volume(0.0)
+                        snake_sound.play()
+                    snake_queue = list(path)
+                    highlight_groups = [set([snake_queue[0]])]
+                    chain_sizes = [1]
+                    showing_highlights_until = now + SNAKE_STEP_DELAY_MS
+                    break
 
-                highlight_groups = None
-                chain_sizes = None
-                highlight_from_bomb = False
-                apply_gravity_and_refill(grid, score)
-                cascade_matches = find_all_matches_wild_any(grid)
-                if cascade_matches:
-                    highlight_groups = cascade_matches
-                    chain_sizes = [len(g) for g in cascade_matches]
-                    highlight_from_bomb = False
-                    added_points = sum(score_for_chain(len(g)) for g in cascade_matches)
-                    score += added_points
-                    add_score_message(added_points)
-
-                    if  any(size >= 5 for size in chain_sizes):
-                        if fiver_sound:
-                            try:
-                                if not mute:
-                                    fiver_sound.set_volume(volume)
-                                else:
-                                    fiver_sound.set_volume(0.0)
-                                fiver_sound.play()
-                            except Exception as e:
-                                print("Error playing fiver sound:", e)
-
-                    next_bomb_time += 1
-                    if timer_duration:
-                        timer_start = add_time(1, timer_duration, timer_start)
+                highlight_groups = groups
+                chain_sizes = sizes
+                score += points
+                add_score_message(points)
+                if cause == "bomb" and bomb_sound:
+                    if not mute:
+                        bomb_sound.set_volume(volume)
+                    else:
+                        bomb_sound.set_volume(0.0)
+                    bomb_sound.play()
+                if cause == "match" and any(size >= 5 for size in sizes):
+                    if fiver_sound:
+                        try:
+                            if not mute:
+                                fiver_sound.set_volume(volume)
+                            else:
+                                fiver_sound.set_volume(0.0)
+                            fiver_sound.play()
+                        except Exception as e:
+                            print("Error playing fiver sound:", e)
+                if cause == "match" or cause == "bomb":
                     if pop_sounds:
                         s = random.choice(pop_sounds)
                         if not mute:
                             s.set_volume(volume)
-                            if has_audio:
-                                try:
-                                    pygame.mixer.music.set_volume(m_volume)
-                                except Exception as e:
-                                    print("Error setting music volume:", e)
                         else:
                             s.set_volume(0.0)
                             volume = 0.0
                             m_volume = 0.0
                         s.play()
-
-                    showing_highlights_until = pygame.time.get_ticks() + HIGHLIGHT_DELAY_MS
-                else:
-                    if not has_moves(grid):
-                        title_type = 2
-                        game_over = True
-                        game_state = GAME_OVER
+                showing_highlights_until = now + HIGHLIGHT_DELAY_MS
+                break
+            elif kind == "fall" or kind == "bomb":
+                view.restore(event[-1])
+            elif kind == "shuffle":
+                view.restore(event[1])
+                showing_highlights_until = now + HIGHLIGHT_DELAY_MS
+                break
+            elif kind == "settled":
+                if game.end == "solved" or game.end == "limit":
+                    title_type = 3 if game.end == "solved" else 4
+                    game_over = True
+                    game_state = GAME_OVER
+                    if game.end == "solved":
+                        puzzle_index += 1
+                elif not event[1]:
+                    title_type = 2
+                    game_over = True
+                    game_state = GAME_OVER
+                    # a practice game that took swaps back doesn't post a score
+                    if not isinstance(game, puzzle.PuzzleGame) and not game.undos:
                         save_highscore(current_difficulty, score)
-                        highscores = load_highscores()
-                        highscore = highscores.get(current_difficulty, 0)
+                        save_replay(game)
+                    highscores = load_highscores()
+                    highscore = highscores.get(current_difficulty, 0)
 
-        if game_state == PLAYING and not game_over:
-            elapsed = (pygame.time.get_ticks() - timer_start) // 1000 if timer_duration else 0
-            if timer_duration and elapsed >= timer_duration:
+        if game_state == PLAYING and not game_over and pending_swap is None:
+            game.step(dt)
+            if game.end == "time":
                 title_type = 1
                 game_over = True
                 game_state = GAME_OVER
+                # points still waiting to be replayed were already earned
+                score = game.score
+                events_left = []
+                snake_queue = []
+                view = game.grid.copy()
+                highlight_groups = None
+                chain_sizes = None
                 save_highscore(current_difficulty, score)
+                save_replay(game)
                 highscores = load_highscores()
                 highscore = highscores.get(current_difficulty, 0)
-                bombs_unlocked = False
-                next_bomb_time = 0
-                highlight_from_bomb = False
 
-        screen.fill(BG_COLOR)
+        hint = None
+        if hint_search is not None and not (events_left or snake_queue or pending_swap):
+            hint = hint_search.run(HINT_BUDGET_MS)
+        elif not (events_left or snake_queue or pending_swap):
+            prefetch.step()
 
-        if game_state == MENU:
-            buttons = draw_menu(screen, custom_font2, custom_font1, skin)
+        if autoplay and not autoplay.should_render():
+            await asyncio.sleep(0)
+            continue
 
-        elif game_state == PLAYING:
-            draw_board(screen, grid, images, font_small, selection, highlight_groups, chain_sizes)
-            draw_header(screen, custom_font1, score, highscores.get(current_difficulty, 0),skin, current_difficulty)
-            elapsed = (pygame.time.get_ticks() - timer_start) // 1000 if timer_duration else 0
+        hurry = False
+        if game_state == PLAYING:
+            elapsed = game.elapsed() if timer_duration else 0
             if timer_duration and (timer_duration - elapsed) >= 23 and timer_duration and (timer_duration - elapsed) <= 24:
                 timer_switch = True
 
@@ -1445,7 +1350,7 @@ async def main():
                 timer_color = (200,160,80)
 
             elif timer_duration and (timer_duration - elapsed) <= 10:
-                draw_hurry(screen, custom_font1)
+                hurry = True
                 timer_color = (200,80,80)
                 if timer_sound:
                     try:
@@ -1454,19 +1359,65 @@ async def main():
                         print("Error setting timer_sound volume:", e)
             else:
                 timer_color = (80,200,80)
-            draw_timer(screen, elapsed, timer_duration, timer_color)    
+
+        now = pygame.time.get_ticks()
+        score_messages[:] = [m for m in score_messages if m.get("until", 0) > now]
+
+        # what is drawn off the board goes in the HUD key, apart from the
+        # parts that change often and redraw just their own rect; the board
+        # is compared cell by cell so a click or a fall redraws just that part
+        hud = (game_state, skin, window.get_size(), tuple(m.get("text") for m in score_messages[-3:]))
+        board = marks = None
+        parts = ()
+        if game_state == MENU:
+            hud += (reshuffle,)
+        else:
+            status = None
+            if isinstance(game, puzzle.PuzzleGame):
+                status = (game.moves_left(), game.score, game.grid.count(SPECIAL_BUBBLE_INDEX))
+            elif game.history is not None:
+                status = (len(game.history), len(game.redo_stack))
+            hud += (GRID_ROWS, GRID_COLS, highscore, title_type, status, volume, m_volume, mute)
+            if game_state == PLAYING:
+                parts = (((score, highscores.get(current_difficulty, 0)), header_rect(custom_font1)),
+                         ((elapsed, timer_color), TIMER_RECT),
+                         (hurry and hurry_flash_timer, hurry_rect(custom_font1)))
+            else:
+                # the game-over panel shows the score too, over the header
+                hud += (score, highscores.get(current_difficulty, 0))
+            board = bytes(view.cells)
+            marks = (selection, hint if game_state == PLAYING else None, highlight_groups, chain_sizes)
+        dirty = frame.plan(screen, hud, board, marks, font_small, parts)
+        if dirty is None:
+            await asyncio.sleep(0)
+            continue
+        # every state starts with an opaque layer over the whole screen
+        screen.set_clip(dirty)
+
+        if game_state == MENU:
+            buttons = draw_menu(screen, custom_font2, custom_font1, skin, reshuffle)
+
+        elif game_state == PLAYING:
+            draw_board(screen, view, images, font_small, selection, highlight_groups, chain_sizes, hint)
+            draw_header(screen, custom_font1, score, highscores.get(current_difficulty, 0),skin, current_difficulty)
+            if hurry:
+                draw_hurry(screen, custom_font1)
+            if isinstance(game, puzzle.PuzzleGame):
+                draw_puzzle_status(screen, custom_font1, game)
+            else:
+                draw_timer(screen, elapsed, timer_duration, timer_color)    
+                if game.history is not None:
+                    draw_practice_status(screen, custom_font1, game)
             up_rect, down_rect = draw_volume_control(screen, volume, font_medium)
             up_rect1, down_rect1 = draw_volume_control1(screen, m_volume, font_medium)
             draw_overlaytop(screen)
 
         elif game_state == GAME_OVER:
-            draw_board(screen, grid, images, font_small, selection, highlight_groups, chain_sizes)            
+            draw_board(screen, view, images, font_small, selection, highlight_groups, chain_sizes)            
             draw_header(screen, custom_font1, score, highscores.get(current_difficulty, 0),skin, current_difficulty)
             draw_overlaytop(screen)
             draw_game_over(screen, custom_font, custom_font1, score, highscore, title_type)
 
-        now = pygame.time.get_ticks()
-        score_messages[:] = [m for m in score_messages if m.get("until", 0) > now]
         base_y = WINDOW_SIZE[1] - 20
         for idx, m in enumerate(reversed(score_messages[-3:])):
             txt = m.get("text")
@@ -1476,30 +1427,17 @@ async def main():
                 col = (200, 200, 255)
             else:
                 col = SCORE_COLOR
-            surf = custom_font1.render(txt, True, col)
+            surf = render_text(custom_font1, txt, col)
             rect = surf.get_rect(center=(WINDOW_SIZE[0]//2, base_y - idx*28))
             screen.blit(surf, rect)
 
-        win_w, win_h = window.get_size()
-        base_w, base_h = WINDOW_SIZE
-        scale = min(win_w / base_w, win_h / base_h) if win_w and win_h else 1.0
-        render_w = int(base_w * scale)
-        render_h = int(base_h * scale)
-        off_x = (win_w - render_w) // 2
-        off_y = (win_h - render_h) // 2
-
-        window.fill((0, 0, 0))
-
-        if render_w != base_w or render_h != base_h:
-            scaled = pygame.transform.smoothscale(screen, (render_w, render_h))
-            window.blit(scaled, (off_x, off_y))
-        else:
-            window.blit(screen, (off_x, off_y))
-        pygame.display.flip()
+        screen.set_clip(None)
+        present(window, screen, None if dirty == screen.get_rect() else dirty)
 
         # Yield control so pygbag's async scheduler can service other tasks.
         await asyncio.sleep(0)
 
     pygame.quit()
 if __name__ == "__main__":
-    asyncio.run(main())
+    autoplay = None if IS_WEB else parse_autoplay(sys.argv[1:])
+    asyncio.run(soak(autoplay) if autoplay else main())
@@ -0,0 +1,242 @@
+import json
+import os
+import random
+import sys
+import time
+
+import engine
+from engine import SPECIAL_BUBBLE_INDEX, Board, GameState, find_match_groups, resolve_move
+from hints import TranspositionTable, immediate_points, legal_moves
+
+# puzzle mode: an authored board, a fixed refill sequence, a move limit and a
+# goal. A puzzle file is JSON:
+#
+#   {"name": "Blast Off", "moves": 3, "goal": {"blockers": true, "score": 200},
+#    "grid": [[0, 1, 2, ...], ...], "refill": [3, 0, 4, 1, ...]}
+#
+# grid holds tile ids as in engine (bombs and the snake included); refill is
+# drawn in order, wrapping round at the end, one tile per gap in the order
+# apply_gravity_and_refill fills them. The goal needs every one of its parts:
+# no blocker left on the board and/or at least that score. The bomb cadence
+# is off, so the only power-ups are the ones the author placed.
+#
+#   python puzzle.py puzzles/*.json    solves each and prints the shortest line
+
+PUZZLE_FOLDER = "puzzles"
+SOLVER_TABLE_SIZE = 200000
+
+
+class Puzzle:
+    __slots__ = ("name", "rows", "refill", "moves", "blockers", "target")
+
+    def __init__(self, name, rows, refill, moves, blockers=False, target=0):
+        self.name = name
+        self.rows = [list(row) for row in rows]
+        self.refill = list(refill)
+        self.moves = moves
+        # goal parts: clear every blocker, reach target points
+        self.blockers = blockers
+        self.target = target
+
+    @classmethod
+    def from_dict(cls, data, name=None):
+        goal = data.get("goal", {})
+        puzzle = cls(data.get("name", name), data["grid"], data["refill"], int(data["moves"]),
+                     bool(goal.get("blockers", False)), int(goal.get("score", 0)))
+        puzzle.check()
+        return puzzle
+
+    def check(self):
+        width = len(self.rows[0]) if self.rows else 0
+        if not width or any(len(row) != width for row in self.rows):
+            raise ValueError(f"{self.name}: the grid must be a non-empty rectangle")
+        for v in [v for row in self.rows for v in row] + self.refill:
+            if not isinstance(v, int) or not 0 <= v < engine.EMPTY or not engine.TILE_FLAGS[v]:
+                raise ValueError(f"{self.name}: {v!r} is not a tile")
+        if not self.refill:
+            raise ValueError(f"{self.name}: the refill sequence is empty")
+        if self.moves < 1:
+            raise ValueError(f"{self.name}: the move limit must be at least 1")
+        if not self.blockers and self.target <= 0:
+            raise ValueError(f"{self.name}: the goal is empty")
+        if find_match_groups(self.board()):
+            raise ValueError(f"{self.name}: the grid starts with a match")
+
+    def board(self):
+        return Board.from_rows(self.rows)
+
+    def solved(self, grid, score):
+        if self.blockers and grid.count(SPECIAL_BUBBLE_INDEX):
+            return False
+        return score >= self.target
+
+
+class RefillRng(random.Random):
+    # draws refills from the puzzle's sequence instead of the spawn tables;
+    # the rest (a snake's path) comes from the generator, which play
+    # reseeds from the position before every swap
+    def __init__(self, refill, cursor=0):
+        super().__init__(0)
+        self.refill = refill
+        self.cursor = cursor
+
+    def choices(self, population, weights=None, *, cum_weights=None, k=1):
+        refill = self.refill
+        n = len(refill)
+        cursor = self.cursor
+        self.cursor = (cursor + k) % n
+        return [refill[(cursor + j) % n] for j in range(k)]
+
+    def reseed(self, grid):
+        self.seed(bytes(grid.cells) + self.cursor.to_bytes(4, "little"))
+
+
+class PuzzleGame(GameState):
+    # a GameState on an authored board; end is "solved" once the goal is met
+    # and "limit" when the moves run out first
+    def __init__(self, puzzle):
+        super().__init__("Free Play", rng=RefillRng(puzzle.refill), grid=puzzle.board())
+        self.puzzle = puzzle
+        self.cadence = False
+
+    def moves_left(self):
+        return self.puzzle.moves - self.swaps
+
+    def swap_steps(self, r1, c1, r2, c2, record=False):
+        self.rng.reseed(self.grid)
+        result = yield from super().swap_steps(r1, c1, r2, c2, record)
+        if result is None or not result["accepted"]:
+            return result
+        if self.puzzle.solved(self.grid, self.score):
+            self.over = True
+            self.end = "solved"
+        elif not self.over and self.swaps >= self.puzzle.moves:
+            self.over = True
+            self.end = "limit"
+        return result
+
+
+class Solver:
+    # iterative deepening depth-first search for the fewest swaps that meet
+    # the goal. Each swap is played on one board and taken back by rewinding
+    # its journal of writes; positions that failed with n moves to spare are remembered so
+    # no line reaching them again with n or fewer is searched twice
+    def __init__(self, puzzle, table_size=SOLVER_TABLE_SIZE):
+        self.puzzle = puzzle
+        self.grid = puzzle.board()
+        self.grid.index_colours()
+        self.rng = RefillRng(puzzle.refill)
+        self.score = 0
+        self.table = TranspositionTable(table_size)
+        self.nodes = 0
+        # blockers only fall to power-ups, and with the cadence off those
+        # come from the board or the refill sequence or not at all
+        self.powers = [v for v in range(engine.EMPTY) if engine.TILE_FLAGS[v] & engine.TILE_BOMB]
+        self.refill_powers = any(v in self.powers for v in puzzle.refill)
+
+    def solve(self):
+        # the shortest list of swaps meeting the goal, or None if there is
+        # none within the move limit
+        if self.puzzle.solved(self.grid, self.score):
+            return []
+        for limit in range(1, self.puzzle.moves + 1):
+            line = []
+            if self.search(limit, line):
+                return line
+        return None
+
+    def make(self, move):
+        (r1, c1), (r2, c2) = move
+        undo = (self.grid.checkpoint(), self.rng.cursor, self.score)
+        self.rng.reseed(self.grid)
+        result = resolve_move(self.grid, r1, c1, r2, c2, self.score, self.rng, record=False,
+                              bomb_pool=[], cadence=False)
+        self.score = result["score"]
+        self.nodes += 1
+        return undo, result
+
+    def unmake(self, undo):
+        point, self.rng.cursor, self.score = undo
+        self.grid.rewind(point)
+
+    def hopeless(self):
+        if not self.puzzle.blockers or not self.grid.count(SPECIAL_BUBBLE_INDEX) or self.refill_powers:
+            return False
+        where = self.grid.where
+        return not any(where[v] for v in self.powers)
+
+    def ordered_moves(self, last):
+        # power-ups first when blockers have to go, then the bigger clears
+        # when points are wanted. Cascades are plain matches, which never
+        # take a blocker, so a last swap that must clear some is a power-up
+        grid = self.grid
+        flags = engine.TILE_FLAGS
+        blockers = self.puzzle.blockers and grid.count(SPECIAL_BUBBLE_INDEX)
+        if self.puzzle.target:
+            self.rng.reseed(grid)
+        ranked = []
+        for move in legal_moves(grid):
+            (r1, c1), (r2, c2) = move
+            power = (flags[grid.get(r1, c1)] | flags[grid.get(r2, c2)]) & engine.TILE_BOMB
+            if blockers and last and not power:
+                continue
+            points = immediate_points(grid, move, self.rng) if self.puzzle.target else 0
+            ranked.append((not (power and blockers), -points, move))
+        ranked.sort()
+        return [move for _, _, move in ranked]
+
+    def search(self, budget, line):
+        key = (bytes(self.grid.cells), self.rng.cursor, self.score if self.puzzle.target else 0)
+        failed = self.table.get(key)
+        if failed is not None and failed >= budget:
+            return False
+        for move in self.ordered_moves(budget == 1):
+            undo, result = self.make(move)
+            line.append(move)
+            if self.puzzle.solved(self.grid, self.score):
+                return True
+            if budget > 1 and result["moves"] and not self.hopeless() and self.search(budget - 1, line):
+                return True
+            line.pop()
+            self.unmake(undo)
+        self.table.put(key, budget)
+        return False
+
+
+def solve(puzzle, table_size=SOLVER_TABLE_SIZE):
+    return Solver(puzzle, table_size).solve()
+
+
+def load(path):
+    with open(path, encoding="utf-8") as f:
+        return Puzzle.from_dict(json.load(f), os.path.splitext(os.path.basename(path))[0])
+
+
+def load_all(folder=PUZZLE_FOLDER):
+    # every puzzle in the folder, in file name order; broken files are skipped
+    puzzles = []
+    if not os.path.isdir(folder):
+        return puzzles
+    for name in sorted(os.listdir(folder)):
+        if name.endswith(".json"):
+            try:
+                puzzles.append(load(os.path.join(folder, name)))
+            except (OSError, KeyError, TypeError, ValueError) as e:
+                print(f"Skipping puzzle {name}: {e}")
+    return puzzles
+
+
+def main(argv=None):
+    for path in sys.argv[1:] if argv is None else argv:
+        puzzle = load(path)
+        solver = Solver(puzzle)
+        began = time.perf_counter()
+        line = solver.solve()
+        took = time.perf_counter() - began
+        verdict = f"solved in {len(line)}: " + " ".join(f"{a}-{b}" for a, b in line) if line is not None \
+            else f"no solution within {puzzle.moves}"
+        print(f"{path}: {verdict} ({solver.nodes} swaps tried in {took:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
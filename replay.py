@@ -0,0 +1,212 @@
+import struct
+import sys
+import time
+from contextlib import contextmanager
+
+import engine
+from engine import DIFFICULTY_SETTINGS, GRID_COLS, GRID_ROWS, GameState, board_size
+
+# compact binary game replays. A game is fully determined by its seed,
+# difficulty and the tick of every swap, so that is all a replay stores:
+#
+#   header   "BSR" version:u8 seed:u64 difficulty:u8 rows:u8 cols:u8 snake:u8 flags:u8
+#   records  varint tick delta (ms), varint code
+#
+# code 0 ends the replay at that tick; otherwise code - 1 is the flat index
+# of the upper or left cell times two, plus 1 for a vertical swap. A move
+# usually takes three or four bytes. Flag bit 0 marks a game that reshuffles
+# instead of ending on no moves; version 1 replays have no flags byte.
+
+MAGIC = b"BSR"
+VERSION = 2
+HEADER = struct.Struct("<3sBQBBBBB")
+HEADER_V1 = struct.Struct("<3sBQBBBB")
+NO_SNAKE = 255
+FLAG_RESHUFFLE = 1
+
+
+class Replay:
+    __slots__ = ("seed", "difficulty", "rows", "cols", "snake", "moves", "end", "reshuffle")
+
+    def __init__(self, seed, difficulty, moves=(), end=0, rows=GRID_ROWS, cols=GRID_COLS, snake=None,
+                 reshuffle=False):
+        self.seed = seed
+        self.difficulty = difficulty
+        self.rows = rows
+        self.cols = cols
+        # tile id of the snake power-up, None when the game had no snake
+        self.snake = snake
+        # (tick, r1, c1, r2, c2) per swap, ticks in game milliseconds
+        self.moves = list(moves)
+        self.end = end
+        self.reshuffle = reshuffle
+
+    @classmethod
+    def from_game(cls, game):
+        return cls(game.seed, game.difficulty, game.log, game.now, game.grid.rows, game.grid.cols,
+                   engine.SNAKE_INDEX, game.reshuffle)
+
+
+def put_varint(out, n):
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def get_varint(data, pos):
+    n = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def encode(replay):
+    if not isinstance(replay.seed, int) or not 0 <= replay.seed < 1 << 64:
+        raise ValueError("replays need a 64-bit integer seed")
+    names = list(DIFFICULTY_SETTINGS)
+    snake = NO_SNAKE if replay.snake is None else replay.snake
+    out = bytearray(HEADER.pack(MAGIC, VERSION, replay.seed, names.index(replay.difficulty),
+                                replay.rows, replay.cols, snake, FLAG_RESHUFFLE if replay.reshuffle else 0))
+    cols = replay.cols
+    last = 0
+    for tick, r1, c1, r2, c2 in replay.moves:
+        if (r2, c2) < (r1, c1):
+            r1, c1, r2, c2 = r2, c2, r1, c1
+        put_varint(out, tick - last)
+        put_varint(out, (r1 * cols + c1) * 2 + (r2 != r1) + 1)
+        last = tick
+    put_varint(out, replay.end - last)
+    put_varint(out, 0)
+    return bytes(out)
+
+
+def decode(data):
+    if len(data) < HEADER_V1.size:
+        raise ValueError("replay is truncated")
+    magic, version, seed, difficulty, rows, cols, snake = HEADER_V1.unpack_from(data)
+    if magic != MAGIC or version not in (1, VERSION):
+        raise ValueError(f"not a version 1 or {VERSION} replay")
+    flags = 0
+    header = HEADER_V1
+    if version == VERSION:
+        if len(data) < HEADER.size:
+            raise ValueError("replay is truncated")
+        flags = HEADER.unpack_from(data)[-1]
+        header = HEADER
+    names = list(DIFFICULTY_SETTINGS)
+    if difficulty >= len(names):
+        raise ValueError(f"unknown difficulty {difficulty}")
+    # checked before the moves, which are decoded against cols
+    if (rows, cols) != board_size(names[difficulty]):
+        raise ValueError(f"replay is for a {rows}x{cols} board")
+    moves = []
+    pos = header.size
+    tick = 0
+    try:
+        while True:
+            delta, pos = get_varint(data, pos)
+            code, pos = get_varint(data, pos)
+            tick += delta
+            if code == 0:
+                break
+            i, down = divmod(code - 1, 2)
+            r, c = divmod(i, cols)
+            moves.append((tick, r, c, r + down, c + 1 - down))
+    except IndexError:
+        raise ValueError("replay is truncated") from None
+    return Replay(seed, names[difficulty], moves, tick, rows, cols, None if snake == NO_SNAKE else snake,
+                  bool(flags & FLAG_RESHUFFLE))
+
+
+@contextmanager
+def replay_tiles(replay):
+    # the replay's snake id while it plays, then the tiles as they were; the
+    # snake only matters once unlocked, but a game without one must never
+    # drop it in
+    bombs, snake = list(engine.BOMB_INDICES), engine.SNAKE_INDEX
+    if replay.snake == snake:
+        yield
+        return
+    engine.configure_tiles(bombs, replay.snake)
+    try:
+        yield
+    finally:
+        engine.configure_tiles(bombs, snake)
+
+
+def start_game(replay, index_moves=True):
+    # the game a replay starts from; play it inside replay_tiles(replay)
+    if (replay.rows, replay.cols) != board_size(replay.difficulty):
+        raise ValueError(f"replay is for a {replay.rows}x{replay.cols} board")
+    return GameState(replay.difficulty, seed=replay.seed, index_moves=index_moves, reshuffle=replay.reshuffle)
+
+
+def play_swap(game, move, record=False):
+    tick, r1, c1, r2, c2 = move
+    game.step(tick - game.now)
+    result = game.swap(r1, c1, r2, c2, record)
+    if result is None or not result["accepted"]:
+        raise ValueError(f"replay diverged at tick {tick}: swap {(r1, c1)}-{(r2, c2)} was refused")
+    return result
+
+
+def iter_replay(replay, record=False):
+    # yields (game, result) after each swap; a viewer can draw between them.
+    # The replay's tiles stay configured until it is exhausted or closed
+    with replay_tiles(replay):
+        game = start_game(replay)
+        for move in replay.moves:
+            yield game, play_swap(game, move, record)
+        game.step(replay.end - game.now)
+
+
+def play_replay(replay, upto=None, index_moves=True):
+    # fast-forwards to the end, or to just after swap number upto
+    with replay_tiles(replay):
+        game = start_game(replay, index_moves)
+        for move in replay.moves[:upto]:
+            play_swap(game, move)
+        if upto is None or upto >= len(replay.moves):
+            game.step(replay.end - game.now)
+    return game
+
+
+def load(path):
+    with open(path, "rb") as f:
+        return decode(f.read())
+
+
+def save(path, replay):
+    with open(path, "wb") as f:
+        f.write(encode(replay))
+
+
+def main(argv=None):
+    # python replay.py FILE... [--repeat N]: plays each replay back at engine
+    # speed and prints how it ended
+    args = list(sys.argv[1:] if argv is None else argv)
+    repeat = 1
+    if "--repeat" in args:
+        at = args.index("--repeat")
+        repeat = int(args[at + 1])
+        del args[at:at + 2]
+    for path in args:
+        with open(path, "rb") as f:
+            data = f.read()
+        replay = decode(data)
+        began = time.perf_counter()
+        for _ in range(repeat):
+            game = play_replay(replay)
+        took = (time.perf_counter() - began) / repeat
+        print(f"{path}: {replay.difficulty}, seed {replay.seed}, {len(replay.moves)} swaps in {len(data)} bytes;"
+              f" score {game.score}, ended by {game.end or 'quitting'} at {game.now / 1000:.1f}s;"
+              f" played back in {took * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
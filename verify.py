@@ -0,0 +1,133 @@
+import argparse
+import base64
+import functools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import engine
+import replay
+
+# batch verification of submitted scores. Each submission is a replay plus
+# the score and ending the client claims; the game is played again headless
+# and the claim accepted only if it comes out the same. Input is JSON lines:
+#
+#   {"id": "abc", "replay": "<base64 replay>", "score": 4210, "end": "moves"}
+#
+# "end" ("time" or "moves") and "difficulty" are optional. Verdicts are
+# printed as JSON lines in the order they finish. Games that reshuffle
+# instead of ending on no moves are rejected unless --allow-reshuffle is
+# given.
+#
+#   python verify.py submissions.jsonl --jobs 8 > verdicts.jsonl
+
+# longer replays are rejected before any work is done on them
+MAX_SWAPS = 100000
+# a swap takes at most a 10-byte tick delta and a 3-byte code, so no
+# replay of MAX_SWAPS swaps is longer than this
+MAX_REPLAY_BYTES = replay.HEADER.size + (MAX_SWAPS + 1) * 13
+# the snake tile id the leaderboard plays with, taken before any replay
+# can reconfigure the tiles; a replay may only name it or have no snake
+SNAKE_INDEX = engine.SNAKE_INDEX
+
+
+def verify(data, score, end=None, difficulty=None, allow_reshuffle=False):
+    # the verdict for one submission: ok, the replayed score and ending, and
+    # why it was rejected
+    if len(data) > MAX_REPLAY_BYTES:
+        return {"ok": False, "reason": f"replay is over {MAX_REPLAY_BYTES} bytes"}
+    try:
+        game_replay = replay.decode(data)
+    except ValueError as e:
+        return {"ok": False, "reason": f"malformed replay: {e}"}
+    if len(game_replay.moves) > MAX_SWAPS:
+        return {"ok": False, "reason": f"more than {MAX_SWAPS} swaps"}
+    if difficulty is not None and difficulty != game_replay.difficulty:
+        return {"ok": False, "reason": f"replay is {game_replay.difficulty}, claimed {difficulty}"}
+    # the header's snake id and mode flags change the rules the game is
+    # played under, so only the leaderboard's own are taken
+    if game_replay.snake not in (SNAKE_INDEX, None):
+        return {"ok": False, "reason": f"replay has snake tile {game_replay.snake}, expected {SNAKE_INDEX}"}
+    if game_replay.reshuffle and not allow_reshuffle:
+        return {"ok": False, "reason": "replay reshuffles, which this leaderboard doesn't allow", "reshuffle": True}
+    try:
+        game = replay.play_replay(game_replay, index_moves=False)
+    except ValueError as e:
+        return {"ok": False, "reason": str(e)}
+    verdict = {"ok": True, "score": game.score, "end": game.end, "swaps": game.swaps,
+               "difficulty": game.difficulty, "reshuffle": game.reshuffle}
+    if game.score != score:
+        verdict.update(ok=False, reason=f"replay scores {game.score}, claimed {score}")
+    elif end is not None and game.end != end:
+        verdict.update(ok=False, reason=f"replay ends by {game.end}, claimed {end}")
+    return verdict
+
+
+def verify_submission(line, allow_reshuffle=False):
+    # one JSON line in, its verdict out; parsed here so the parent process
+    # only reads lines. Nothing a submission holds may raise out of here, or
+    # it would end the whole batch
+    try:
+        submission = json.loads(line)
+    except ValueError as e:
+        return {"ok": False, "reason": f"bad submission: {e}", "id": None}
+    if not isinstance(submission, dict):
+        return {"ok": False, "reason": "bad submission: not an object", "id": None}
+    try:
+        text = submission["replay"]
+        if len(text) > (MAX_REPLAY_BYTES + 2) // 3 * 4:
+            raise ValueError(f"replay is over {MAX_REPLAY_BYTES} bytes")
+        data = base64.b64decode(text, validate=True)
+        score = int(submission["score"])
+    except (KeyError, TypeError, ValueError, OverflowError) as e:
+        verdict = {"ok": False, "reason": f"bad submission: {e}"}
+    else:
+        try:
+            verdict = verify(data, score, submission.get("end"), submission.get("difficulty"), allow_reshuffle)
+        except Exception as e:
+            verdict = {"ok": False, "reason": f"replay failed: {type(e).__name__}: {e}"}
+    verdict["id"] = submission.get("id")
+    return verdict
+
+
+def verify_many(submissions, jobs=None, chunksize=8, allow_reshuffle=False):
+    # yields verdicts as workers finish them, not in submission order
+    check = functools.partial(verify_submission, allow_reshuffle=allow_reshuffle)
+    with multiprocessing.Pool(jobs) as pool:
+        yield from pool.imap_unordered(check, submissions, chunksize)
+
+
+def read_submissions(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay submitted games and check their claimed scores.")
+    parser.add_argument("submissions", nargs="?", help="JSON lines file, - or nothing for stdin")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk", type=int, default=8, help="submissions per worker task")
+    parser.add_argument("--allow-reshuffle", action="store_true",
+                        help="accept games that reshuffle instead of ending on no moves")
+    args = parser.parse_args(argv)
+
+    stream = sys.stdin if args.submissions in (None, "-") else open(args.submissions, encoding="utf-8")
+    began = time.perf_counter()
+    counts = {True: 0, False: 0}
+    with stream:
+        for verdict in verify_many(read_submissions(stream), args.jobs, args.chunk, args.allow_reshuffle):
+            counts[verdict["ok"]] += 1
+            print(json.dumps(verdict), flush=True)
+    took = time.perf_counter() - began
+    total = counts[True] + counts[False]
+    print(f"{total} verified in {took:.1f}s ({total / took if took else 0:.0f}/s):"
+          f" {counts[True]} ok, {counts[False]} rejected", file=sys.stderr)
+    return 0 if not counts[False] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())